@@ -0,0 +1,262 @@
+import sqlite3
+import threading
+import pathlib
+import socket
+import json
+import time
+import os
+
+JOB_PENDING = "pending"
+JOB_IN_PROGRESS = "in_progress"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_SKIPPED = "skipped"
+
+# Jobs claimed by a process which hasn't sent a heartbeat for this long are assumed to belong to a crashed process
+STALE_CLAIM_SECONDS = 120
+
+ORDER_QUEUE = "queue"
+ORDER_SMALLEST_FIRST = "smallest-first"
+ORDER_AT_RISK_FIRST = "at-risk-first"
+ORDER_PRIORITY = "priority"
+
+job_order_clauses = {
+    ORDER_QUEUE: "id",
+    # videos with an unknown size last
+    ORDER_SMALLEST_FIRST: "filesize IS NULL, filesize, id",
+    ORDER_AT_RISK_FIRST: "at_risk DESC, id",
+    ORDER_PRIORITY: "priority DESC, id",
+}
+
+class DownloadJob:
+    __slots__ = ("id", "url", "src_link", "at_risk", "attempts", "filesize", "duration", "run_seconds")
+
+    def __init__(self, id, url, src_link, at_risk, attempts, filesize=None, duration=None, run_seconds=None):
+        self.id = id
+        self.url = url
+        self.src_link = src_link
+        self.at_risk = at_risk
+        self.attempts = attempts
+        # probed size in bytes, or None if unknown
+        self.filesize = filesize
+        # probed duration in seconds, or None if unknown
+        self.duration = duration
+        # length of the run in the video in seconds, or None if unknown
+        self.run_seconds = run_seconds
+
+# Entries are either {"url": ..., "src_link": ..., "priority": ..., "run_seconds": ...}, or [url, src_link] and url from older versions
+def parse_remaining_download(url_info):
+    priority = 0
+    run_seconds = None
+    if isinstance(url_info, dict):
+        url = url_info["url"]
+        src_link = url_info.get("src_link", "N/A")
+        priority = url_info.get("priority", 0)
+        run_seconds = url_info.get("run_seconds")
+    elif isinstance(url_info, list):
+        url, src_link = url_info[0], url_info[1]
+    else:
+        url = url_info
+        src_link = "N/A"
+
+    at_risk = url.endswith("*****")
+    return url.replace("*****", ""), src_link, at_risk, priority, run_seconds
+
+# Persistent download queue in a sqlite database, recording the state of every download.
+# Claiming the next job is a single indexed update, and the database can be shared by several
+# processes. Claimed jobs are kept alive with heartbeats, so jobs of a crashed process go back to pending.
+class DownloadQueue:
+    __slots__ = ("connection", "lock", "owner")
+
+    def __init__(self, queue_filename):
+        self.lock = threading.Lock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        # only ever used under self.lock
+        self.connection = sqlite3.connect(queue_filename, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("""\
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    src_link TEXT NOT NULL,
+    at_risk INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    owner TEXT,
+    heartbeat_at REAL,
+    updated_at REAL NOT NULL,
+    UNIQUE (url, src_link)
+)""")
+            self.add_missing_columns({"not_before": "REAL", "error_class": "TEXT", "probed": "INTEGER NOT NULL DEFAULT 0", "filesize": "INTEGER", "duration": "REAL", "priority": "REAL NOT NULL DEFAULT 0", "filepath": "TEXT", "sha256": "TEXT", "verified_at": "REAL", "run_seconds": "REAL"})
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state_id ON jobs (state, id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state_filesize ON jobs (state, filesize)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, priority DESC, id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        self.recover_stale_jobs()
+
+    # for queues created by older versions, must be called inside a transaction
+    def add_missing_columns(self, column_types):
+        columns = frozenset(row[1] for row in self.connection.execute("PRAGMA table_info(jobs)"))
+        for column_name, column_type in column_types.items():
+            if column_name not in columns:
+                self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {column_name} {column_type}")
+
+    def recover_stale_jobs(self):
+        with self.lock:
+            with self.connection:
+                cursor = self.connection.execute("UPDATE jobs SET state = ?, owner = NULL WHERE state = ? AND heartbeat_at < ?", (JOB_PENDING, JOB_IN_PROGRESS, time.time() - STALE_CLAIM_SECONDS))
+
+        if cursor.rowcount != 0:
+            print(f"Resuming {cursor.rowcount} downloads which were interrupted")
+
+    # Brings the queue in line with the remaining downloads file, if it changed since it was last read.
+    # New entries are added as pending, and pending entries which were removed from the file are dropped.
+    # Entries which were already downloaded stay done, but take over the priority from the file.
+    def sync_from_remaining_downloads(self, remaining_downloads_filename):
+        remaining_downloads_filepath = pathlib.Path(remaining_downloads_filename)
+        try:
+            remaining_downloads_mtime = str(remaining_downloads_filepath.stat().st_mtime_ns)
+        except FileNotFoundError:
+            return
+
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'remaining_downloads_mtime'").fetchone()
+            if row is not None and row[0] == remaining_downloads_mtime:
+                return
+
+        try:
+            with open(remaining_downloads_filename, "r", encoding="utf-8") as f:
+                urls = json.load(f)
+        except json.JSONDecodeError:
+            print("Error reading JSON file")
+            return
+
+        cur_time = time.time()
+        remaining_downloads = [parse_remaining_download(url_info) for url_info in urls]
+        with self.lock:
+            with self.connection:
+                self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS synced_jobs (url TEXT NOT NULL, src_link TEXT NOT NULL)")
+                self.connection.execute("DELETE FROM synced_jobs")
+                self.connection.executemany("INSERT INTO synced_jobs (url, src_link) VALUES (?, ?)", ((url, src_link) for url, src_link, at_risk, priority, run_seconds in remaining_downloads))
+                self.connection.execute("DELETE FROM jobs WHERE state = ? AND NOT EXISTS (SELECT 1 FROM synced_jobs WHERE synced_jobs.url = jobs.url AND synced_jobs.src_link = jobs.src_link)", (JOB_PENDING,))
+                # Jobs skipped because their channel wasn't at risk are queued again once it is, and failed jobs
+                # which a new scrape lists again get another chance. (SET expressions see the row before the update)
+                self.connection.executemany(f"""\
+INSERT INTO jobs (url, src_link, at_risk, state, updated_at, priority, run_seconds) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (url, src_link) DO UPDATE SET priority = excluded.priority, run_seconds = excluded.run_seconds, at_risk = excluded.at_risk,
+    state = CASE WHEN state = '{JOB_FAILED}' OR (state = '{JOB_SKIPPED}' AND excluded.at_risk) THEN '{JOB_PENDING}' ELSE state END,
+    attempts = CASE WHEN state = '{JOB_FAILED}' THEN 0 ELSE attempts END,
+    not_before = CASE WHEN state = '{JOB_FAILED}' THEN NULL ELSE not_before END,
+    updated_at = excluded.updated_at""", ((url, src_link, at_risk, JOB_PENDING, cur_time, priority, run_seconds) for url, src_link, at_risk, priority, run_seconds in remaining_downloads))
+                self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('remaining_downloads_mtime', ?)", (remaining_downloads_mtime,))
+
+    # Claims the next job in the given order whose probed size is at most `max_filesize` bytes (if given)
+    def claim_next(self, order=ORDER_QUEUE, max_filesize=None):
+        cur_time = time.time()
+        order_clause = job_order_clauses[order]
+        with self.lock:
+            with self.connection:
+                row = self.connection.execute(f"""\
+UPDATE jobs SET state = ?, owner = ?, heartbeat_at = ?, updated_at = ?, attempts = attempts + 1
+WHERE id = (SELECT id FROM jobs WHERE state = ? AND (not_before IS NULL OR not_before <= ?) AND (? IS NULL OR filesize IS NULL OR filesize <= ?) ORDER BY {order_clause} LIMIT 1)
+RETURNING id, url, src_link, at_risk, attempts, filesize, duration, run_seconds""", (JOB_IN_PROGRESS, self.owner, cur_time, cur_time, JOB_PENDING, cur_time, max_filesize, max_filesize)).fetchone()
+
+        if row is None:
+            return None
+
+        return DownloadJob(row[0], row[1], row[2], bool(row[3]), row[4], row[5], row[6], row[7])
+
+    def set_job_state(self, job, state, error=None, error_class=None, not_before=None):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE jobs SET state = ?, last_error = ?, error_class = ?, not_before = ?, owner = NULL, updated_at = ? WHERE id = ?", (state, error, error_class, not_before, time.time(), job.id))
+
+    def mark_done(self, job):
+        self.set_job_state(job, JOB_DONE)
+
+    def mark_failed(self, job, error, error_class=None):
+        self.set_job_state(job, JOB_FAILED, error, error_class)
+
+    # Puts a failed job back into the queue, to be retried no earlier than `not_before`
+    def requeue(self, job, error, error_class, not_before):
+        self.set_job_state(job, JOB_PENDING, error, error_class, not_before)
+
+    # Fails the pending jobs which are known to be larger than `max_filesize`, and returns them
+    def fail_jobs_larger_than(self, max_filesize, error, error_class=None):
+        with self.lock:
+            with self.connection:
+                rows = self.connection.execute("UPDATE jobs SET state = ?, last_error = ?, error_class = ?, owner = NULL, updated_at = ? WHERE state = ? AND filesize > ? RETURNING id, url, src_link, at_risk, attempts, filesize", (JOB_FAILED, error, error_class, time.time(), JOB_PENDING, max_filesize)).fetchall()
+
+        return [DownloadJob(row[0], row[1], row[2], bool(row[3]), row[4], row[5]) for row in rows]
+
+    # Returns the earliest time a pending job may be retried, or None if there are no pending jobs
+    def get_next_retry_time(self):
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*), MIN(COALESCE(not_before, 0)) FROM jobs WHERE state = ?", (JOB_PENDING,)).fetchone()
+
+        if row[0] == 0:
+            return None
+
+        return row[1]
+
+    # Returns the pending jobs whose metadata hasn't been probed yet
+    def get_unprobed_jobs(self, at_risk_only):
+        with self.lock:
+            rows = self.connection.execute(f"SELECT id, url, src_link, at_risk, attempts, run_seconds FROM jobs WHERE state = ? AND probed = 0{' AND at_risk = 1' if at_risk_only else ''} ORDER BY id", (JOB_PENDING,)).fetchall()
+
+        return [DownloadJob(row[0], row[1], row[2], bool(row[3]), row[4], run_seconds=row[5]) for row in rows]
+
+    def record_probe(self, job, filesize, duration):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE jobs SET probed = 1, filesize = ?, duration = ?, updated_at = ? WHERE id = ?", (filesize, duration, time.time(), job.id))
+
+    # Remembers where a downloaded video was saved, until it has been verified
+    def record_downloaded_file(self, job, filepath, duration):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE jobs SET filepath = ?, duration = COALESCE(duration, ?), sha256 = NULL, verified_at = NULL, updated_at = ? WHERE id = ?", (filepath, duration, time.time(), job.id))
+
+    def record_verified(self, job, filepath, sha256):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE jobs SET filepath = ?, sha256 = ?, verified_at = ?, updated_at = ? WHERE id = ?", (filepath, sha256, time.time(), time.time(), job.id))
+
+    # Returns (job, filepath, duration) of the downloaded videos which weren't verified yet, e.g. because downloading was interrupted
+    def get_unverified_jobs(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, url, src_link, at_risk, attempts, filesize, duration, filepath, run_seconds FROM jobs WHERE state = ? AND filepath IS NOT NULL AND verified_at IS NULL ORDER BY id", (JOB_DONE,)).fetchall()
+
+        return [(DownloadJob(row[0], row[1], row[2], bool(row[3]), row[4], row[5], row[6], row[8]), row[7], row[6]) for row in rows]
+
+    def mark_skipped(self, job):
+        self.set_job_state(job, JOB_SKIPPED)
+
+    def heartbeat(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE jobs SET heartbeat_at = ? WHERE state = ? AND owner = ?", (time.time(), JOB_IN_PROGRESS, self.owner))
+
+    # Puts the jobs claimed by this process back into the queue, e.g. when the user stops the downloads
+    def release_claimed_jobs(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE jobs SET state = ?, owner = NULL, attempts = attempts - 1 WHERE state = ? AND owner = ?", (JOB_PENDING, JOB_IN_PROGRESS, self.owner))
+
+    # Returns how many jobs are pending, their total probed size, and how many of them weren't probed
+    def get_pending_filesizes(self):
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(filesize), 0), COUNT(*) - COUNT(filesize) FROM jobs WHERE state = ?", (JOB_PENDING,)).fetchone()
+
+        return row[0], row[1], row[2]
+
+    def count_jobs(self, state):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
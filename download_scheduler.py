@@ -0,0 +1,181 @@
+import threading
+import pathlib
+import shutil
+import time
+import re
+import os
+
+ERROR_DEAD = "dead"
+ERROR_LIVE = "live"
+ERROR_THROTTLED = "throttled"
+ERROR_TRANSIENT = "transient"
+ERROR_OTHER = "other"
+# not a download error, the video is larger than the disk budget
+ERROR_TOO_LARGE = "too_large"
+
+dead_error_regex = re.compile(r"does not exist|HTTP Error 404|has been deleted|This video is (?:unavailable|private)", re.IGNORECASE)
+live_error_regex = re.compile(r"The channel is not currently live|live stream", re.IGNORECASE)
+throttled_error_regex = re.compile(r"HTTP Error (?:429|403)|Too Many Requests|rate.?limit", re.IGNORECASE)
+transient_error_regex = re.compile(r"timed? ?out|Connection (?:reset|refused|aborted)|HTTP Error 5\d\d|IncompleteRead|Temporary failure|Unable to download|Remote end closed|Network is unreachable|Got error|giving up after", re.IGNORECASE)
+
+def classify_download_error(error_msg):
+    # dead links are checked first, since their messages can also mention e.g. "Unable to download"
+    if dead_error_regex.search(error_msg):
+        return ERROR_DEAD
+    elif live_error_regex.search(error_msg):
+        return ERROR_LIVE
+    elif throttled_error_regex.search(error_msg):
+        return ERROR_THROTTLED
+    elif transient_error_regex.search(error_msg):
+        return ERROR_TRANSIENT
+    else:
+        return ERROR_OTHER
+
+DEFAULT_MIN_DELAY = 5
+DEFAULT_MAX_DELAY = 600
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Paces the download workers and decides when failed downloads are retried.
+# While downloads succeed, workers only wait `min_delay` between downloads. Every throttled download
+# doubles the delay (up to `max_delay`) and pauses all workers for that long, and successful downloads
+# halve it again. Failed downloads are retried later with exponential backoff instead of blocking a worker,
+# except for dead links and live streams, which will not start working by waiting.
+class DownloadScheduler:
+    __slots__ = ("lock", "min_delay", "max_delay", "max_attempts", "delay", "paused_until")
+
+    def __init__(self, min_delay=DEFAULT_MIN_DELAY, max_delay=DEFAULT_MAX_DELAY, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.lock = threading.Lock()
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.max_attempts = max_attempts
+        self.delay = min_delay
+        self.paused_until = 0
+
+    def record_success(self):
+        with self.lock:
+            self.delay = max(self.min_delay, self.delay / 2)
+
+    # Returns how many seconds to wait before retrying the download, or None if it shouldn't be retried
+    def record_failure(self, error_class, attempts):
+        if error_class in (ERROR_DEAD, ERROR_LIVE):
+            return None
+
+        if error_class == ERROR_THROTTLED:
+            with self.lock:
+                self.delay = min(self.max_delay, max(self.delay * 2, 30))
+                self.paused_until = max(self.paused_until, time.time() + self.delay)
+                print(f"Download was throttled, pausing all downloads for {self.delay:.0f} seconds.")
+
+        if attempts >= self.max_attempts:
+            return None
+
+        if error_class == ERROR_THROTTLED:
+            base_retry_delay = 300
+        elif error_class == ERROR_TRANSIENT:
+            base_retry_delay = 30
+        else:
+            base_retry_delay = 120
+
+        return min(base_retry_delay * 2 ** (attempts - 1), 6 * 3600)
+
+    def get_delay(self):
+        with self.lock:
+            return self.delay
+
+    # Returns False if `stop_event` was set while waiting
+    def wait_until_unpaused(self, stop_event):
+        while True:
+            with self.lock:
+                pause_time = self.paused_until - time.time()
+
+            if pause_time <= 0:
+                return True
+
+            if stop_event.wait(pause_time):
+                return False
+
+DEFAULT_MIN_FREE_SPACE = 1024 ** 3
+# how often the size of the video folder is measured again, to notice videos being moved elsewhere
+DISK_USAGE_REFRESH_SECONDS = 60
+
+def get_folder_size(folder_name):
+    folder_size = 0
+    # hardlinked files (e.g. from the video store) only take up space once
+    hardlinked_files = set()
+    for dirpath, dirnames, filenames in os.walk(folder_name):
+        for filename in filenames:
+            try:
+                file_stat = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                # e.g. a fragment which was deleted in the meantime
+                continue
+
+            if file_stat.st_nlink > 1:
+                file_id = (file_stat.st_dev, file_stat.st_ino)
+                if file_id in hardlinked_files:
+                    continue
+                hardlinked_files.add(file_id)
+
+            folder_size += file_stat.st_size
+
+    return folder_size
+
+# Only lets downloads start if they fit on the disk. The videos in the video folder may use at most `budget` bytes,
+# and `min_free_space` bytes are always left free on the disk. Downloads which are in progress reserve their
+# probed size, so that workers don't start downloads which only fit if the others didn't exist.
+# Videos whose size wasn't probed are let through as long as there is any space left.
+class DiskAdmission:
+    __slots__ = ("lock", "folder_name", "budget", "min_free_space", "used_bytes", "reserved_bytes", "refreshed_at", "paused")
+
+    def __init__(self, folder_name, budget=None, min_free_space=DEFAULT_MIN_FREE_SPACE):
+        self.lock = threading.Lock()
+        pathlib.Path(folder_name).mkdir(parents=True, exist_ok=True)
+        self.folder_name = folder_name
+        self.budget = budget
+        self.min_free_space = min_free_space
+        self.used_bytes = 0
+        self.reserved_bytes = 0
+        self.refreshed_at = None
+        self.paused = False
+
+    # must be called with self.lock held
+    def get_available_bytes(self):
+        cur_time = time.time()
+        if self.refreshed_at is None or cur_time - self.refreshed_at >= DISK_USAGE_REFRESH_SECONDS:
+            if self.budget is not None:
+                # includes the partially downloaded videos, so those count twice until they are done
+                self.used_bytes = get_folder_size(self.folder_name)
+            self.refreshed_at = cur_time
+
+        available_bytes = shutil.disk_usage(self.folder_name).free - self.min_free_space - self.reserved_bytes
+        if self.budget is not None:
+            available_bytes = min(available_bytes, self.budget - self.used_bytes - self.reserved_bytes)
+
+        return available_bytes
+
+    # `claim_next` is called with the number of bytes available, and returns the claimed job or None
+    def admit(self, claim_next):
+        with self.lock:
+            available_bytes = self.get_available_bytes()
+            job = claim_next(available_bytes) if available_bytes > 0 else None
+            if job is not None and job.filesize is not None:
+                self.reserved_bytes += job.filesize
+
+            return job
+
+    def release(self, job, downloaded):
+        if job.filesize is None:
+            return
+
+        with self.lock:
+            self.reserved_bytes -= job.filesize
+            if downloaded:
+                self.used_bytes += job.filesize
+
+    # Returns True if the downloads were paused by this call
+    def set_paused(self, paused):
+        with self.lock:
+            was_paused = self.paused
+            self.paused = paused
+
+        return paused and not was_paused
@@ -0,0 +1,161 @@
+import collections
+import threading
+import json
+import time
+import os
+
+# how many finished downloads are listed in the stats file
+NUM_RECENT_DOWNLOADS = 100
+
+class ActiveDownload:
+    __slots__ = ("url", "started_at", "finished_parts_bytes", "progress")
+
+    def __init__(self, url):
+        self.url = url
+        self.started_at = time.time()
+        # videos with separate video and audio formats are downloaded in several parts
+        self.finished_parts_bytes = 0
+        self.progress = None
+
+    def get_downloaded_bytes(self):
+        if self.progress is None or self.progress["status"] != "downloading":
+            return self.finished_parts_bytes
+
+        return self.finished_parts_bytes + (self.progress.get("downloaded_bytes") or 0)
+
+    def get_total_bytes(self):
+        if self.progress is None or self.progress["status"] != "downloading":
+            return None
+
+        total_bytes = self.progress.get("total_bytes") or self.progress.get("total_bytes_estimate")
+        if total_bytes is None:
+            return None
+
+        return self.finished_parts_bytes + total_bytes
+
+    def get_speed(self):
+        if self.progress is None or self.progress["status"] != "downloading":
+            return None
+
+        return self.progress.get("speed")
+
+# Throughput of the downloads of a session, fed by yt-dlp's progress hooks of every worker
+class DownloadStats:
+    __slots__ = ("lock", "started_at", "active_downloads", "recent_downloads", "finished_bytes", "num_downloaded", "num_failed")
+
+    def __init__(self, num_workers):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.active_downloads = [None] * num_workers
+        self.recent_downloads = collections.deque(maxlen=NUM_RECENT_DOWNLOADS)
+        # bytes of the downloads which are done, including failed ones
+        self.finished_bytes = 0
+        self.num_downloaded = 0
+        self.num_failed = 0
+
+    def start_download(self, worker_index, url):
+        with self.lock:
+            self.active_downloads[worker_index] = ActiveDownload(url)
+
+    def update_progress(self, worker_index, progress):
+        with self.lock:
+            active_download = self.active_downloads[worker_index]
+            if active_download is None:
+                return
+
+            if progress["status"] == "finished":
+                active_download.finished_parts_bytes += progress.get("total_bytes") or progress.get("downloaded_bytes") or 0
+
+            active_download.progress = progress
+
+    def finish_download(self, worker_index, downloaded):
+        cur_time = time.time()
+        with self.lock:
+            active_download = self.active_downloads[worker_index]
+            if active_download is None:
+                return
+
+            self.active_downloads[worker_index] = None
+            downloaded_bytes = active_download.get_downloaded_bytes()
+            elapsed = cur_time - active_download.started_at
+            self.finished_bytes += downloaded_bytes
+            if downloaded:
+                self.num_downloaded += 1
+            else:
+                self.num_failed += 1
+
+            self.recent_downloads.append({
+                "url": active_download.url,
+                "downloaded": downloaded,
+                "bytes": downloaded_bytes,
+                "seconds": round(elapsed, 1),
+                "average_speed": round(downloaded_bytes / elapsed) if elapsed > 0 else None,
+            })
+
+    # Returns (downloaded bytes, total bytes or None, speed or None) of every worker, or None for idle workers
+    def get_worker_progress(self):
+        with self.lock:
+            return [None if active_download is None or active_download.progress is None else (active_download.get_downloaded_bytes(), active_download.get_total_bytes(), active_download.get_speed()) for active_download in self.active_downloads]
+
+    # `pending_bytes` is the probed size of the downloads which haven't started, `num_pending_unknown_size` how many of them weren't probed
+    def create_stats(self, num_pending, pending_bytes, num_pending_unknown_size):
+        cur_time = time.time()
+        with self.lock:
+            downloads = []
+            downloaded_bytes = self.finished_bytes
+            current_speed = 0
+            bytes_remaining = pending_bytes
+            for worker_index, active_download in enumerate(self.active_downloads):
+                if active_download is None:
+                    continue
+
+                active_downloaded_bytes = active_download.get_downloaded_bytes()
+                total_bytes = active_download.get_total_bytes()
+                speed = active_download.get_speed()
+                downloaded_bytes += active_downloaded_bytes
+                if speed is not None:
+                    current_speed += speed
+                if total_bytes is not None:
+                    bytes_remaining += max(total_bytes - active_downloaded_bytes, 0)
+                else:
+                    num_pending_unknown_size += 1
+
+                downloads.append({
+                    "worker": worker_index + 1,
+                    "url": active_download.url,
+                    "downloaded_bytes": active_downloaded_bytes,
+                    "total_bytes": total_bytes,
+                    "speed": round(speed) if speed is not None else None,
+                    "eta": active_download.progress.get("eta") if active_download.progress is not None else None,
+                    "seconds": round(cur_time - active_download.started_at, 1),
+                })
+
+            elapsed = cur_time - self.started_at
+            average_speed = downloaded_bytes / elapsed if elapsed > 0 else 0
+            return {
+                "updated_at": cur_time,
+                "session": {
+                    "started_at": self.started_at,
+                    "seconds": round(elapsed, 1),
+                    "downloaded_bytes": downloaded_bytes,
+                    "average_speed": round(average_speed),
+                    "current_speed": round(current_speed),
+                    "num_downloaded": self.num_downloaded,
+                    "num_failed": self.num_failed,
+                    "num_remaining": num_pending + len(downloads),
+                    # only counts the downloads whose size is known
+                    "bytes_remaining": bytes_remaining,
+                    "num_remaining_unknown_size": num_pending_unknown_size,
+                    "eta": round(bytes_remaining / average_speed) if average_speed > 0 else None,
+                },
+                "downloads": downloads,
+                "recent_downloads": list(self.recent_downloads),
+            }
+
+    def write(self, stats_filename, num_pending, pending_bytes, num_pending_unknown_size):
+        stats = self.create_stats(num_pending, pending_bytes, num_pending_unknown_size)
+        temp_stats_filename = f"{stats_filename}.tmp"
+        with open(temp_stats_filename, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+
+        os.replace(temp_stats_filename, stats_filename)
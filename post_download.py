@@ -0,0 +1,214 @@
+import concurrent.futures
+import subprocess
+import threading
+import hashlib
+import pathlib
+import queue
+import json
+import time
+import os
+
+# allowed difference between the duration of a downloaded video and the duration reported by the site
+DURATION_TOLERANCE_SECONDS = 5
+DURATION_TOLERANCE_RATIO = 0.01
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+# how long the threads get to stop when closing without waiting for the queued videos
+STOP_TIMEOUT_SECONDS = 5
+
+# Returns the container format and duration of a media file according to ffprobe.
+# Raises RuntimeError if the file can't be read, and FileNotFoundError if ffprobe isn't installed.
+def probe_media_file(filepath):
+    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=format_name,duration", "-of", "json", filepath], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe could not read {filepath}: {result.stderr.strip()}")
+
+    media_format = json.loads(result.stdout).get("format", {})
+    duration = media_format.get("duration")
+    return media_format.get("format_name"), float(duration) if duration is not None else None
+
+# Returns an error message if the file isn't a complete video, otherwise None
+def verify_media_file(filepath, expected_duration):
+    try:
+        format_name, duration = probe_media_file(filepath)
+    except RuntimeError as e:
+        return str(e)
+
+    if format_name is None:
+        return f"Unknown container format for {filepath}"
+
+    if expected_duration is not None:
+        if duration is None:
+            return f"Could not determine the duration of {filepath}"
+
+        if duration < expected_duration - max(DURATION_TOLERANCE_SECONDS, expected_duration * DURATION_TOLERANCE_RATIO):
+            return f"Downloaded file is incomplete: {filepath} is {duration:.0f} seconds long instead of {expected_duration:.0f} seconds"
+
+    return None
+
+# Runs in a worker process. Returns the filepath of the converted video, the original is deleted.
+def convert_video(filepath, remux_format, compress_crf):
+    input_filepath = pathlib.Path(filepath)
+    output_suffix = f".{remux_format}" if remux_format is not None else input_filepath.suffix
+    output_filepath = input_filepath.with_suffix(output_suffix)
+    temp_output_filepath = input_filepath.with_suffix(f".converting{output_suffix}")
+
+    if compress_crf is not None:
+        codec_args = ["-c:v", "libx264", "-crf", str(compress_crf), "-preset", "medium", "-c:a", "copy"]
+    else:
+        codec_args = ["-c", "copy"]
+
+    result = subprocess.run(["ffmpeg", "-y", "-v", "error", "-i", str(input_filepath), *codec_args, str(temp_output_filepath)], capture_output=True, text=True)
+    if result.returncode != 0:
+        temp_output_filepath.unlink(missing_ok=True)
+        raise RuntimeError(f"ffmpeg could not convert {filepath}: {result.stderr.strip()}")
+
+    os.replace(temp_output_filepath, output_filepath)
+    if output_filepath != input_filepath:
+        input_filepath.unlink()
+
+    return str(output_filepath)
+
+# Runs in a worker process
+def compute_sha256(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(CHECKSUM_CHUNK_SIZE):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+class PostDownloadSettings:
+    __slots__ = ("verify", "remux_format", "compress_crf", "num_workers")
+
+    def __init__(self, verify=False, remux_format=None, compress_crf=None, num_workers=1):
+        self.verify = verify
+        self.remux_format = remux_format
+        self.compress_crf = compress_crf
+        self.num_workers = max(1, num_workers)
+
+    def is_enabled(self):
+        return self.verify or self.remux_format is not None or self.compress_crf is not None
+
+# Checks, converts and checksums downloaded videos, separately from the download workers so that they
+# can start the next download right away. Downloaded videos are put into a queue, which is worked off by
+# `num_workers` threads. The CPU heavy parts (conversion and checksums) run in a process pool.
+# `on_failure(job, filepath, error_msg)` is called for videos which turn out to be broken, after they were deleted,
+# and `on_success(job, filepath, new_filepath)` (if given) for the others, with the filepath they have after converting.
+class PostDownloadStage:
+    __slots__ = ("settings", "download_queue", "checksums_filename", "on_failure", "on_success", "work_queue", "threads", "executor", "lock", "ffprobe_missing", "closed", "num_unfinished")
+
+    def __init__(self, settings, download_queue, checksums_filename, on_failure, on_success=None):
+        self.settings = settings
+        self.download_queue = download_queue
+        self.checksums_filename = checksums_filename
+        self.on_failure = on_failure
+        self.on_success = on_success
+        self.work_queue = queue.Queue()
+        self.threads = []
+        self.executor = None
+        self.lock = threading.Lock()
+        self.ffprobe_missing = False
+        # set once the stage is closed, after which no more videos are started
+        self.closed = threading.Event()
+        # submitted videos which are waiting or being processed
+        self.num_unfinished = 0
+
+    def start(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.settings.num_workers)
+        self.threads = [threading.Thread(target=self.run, daemon=True) for i in range(self.settings.num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job, filepath, duration):
+        with self.lock:
+            self.num_unfinished += 1
+        self.work_queue.put((job, filepath, duration))
+
+    def get_num_waiting(self):
+        return self.work_queue.qsize()
+
+    # Whether videos are still waiting or being processed, which may still fail and be queued for download again
+    def is_busy(self):
+        with self.lock:
+            return self.num_unfinished != 0
+
+    def run(self):
+        while True:
+            item = self.work_queue.get()
+            if item is None or self.closed.is_set():
+                break
+
+            job, filepath, duration = item
+            try:
+                self.process(job, filepath, duration)
+            except Exception as e:
+                # when closed without waiting, the executor cancels the work it hasn't started,
+                # and the download queue may be closed before a video being converted is recorded
+                if not self.closed.is_set():
+                    print(f"Could not process {filepath}: {e}")
+            finally:
+                with self.lock:
+                    self.num_unfinished -= 1
+
+    def verify(self, filepath, duration):
+        if not self.settings.verify or self.ffprobe_missing:
+            return None
+
+        try:
+            return verify_media_file(filepath, duration)
+        except FileNotFoundError:
+            with self.lock:
+                if not self.ffprobe_missing:
+                    print("ffprobe not found, downloaded videos are not checked. Install ffmpeg to check them.")
+                    self.ffprobe_missing = True
+
+            return None
+
+    def process(self, job, downloaded_filepath, duration):
+        settings = self.settings
+        filepath = downloaded_filepath
+        error_msg = self.verify(filepath, duration)
+        if self.closed.is_set():
+            # the video is checked again next time
+            return
+
+        if error_msg is None and (settings.remux_format is not None or settings.compress_crf is not None):
+            try:
+                filepath = self.executor.submit(convert_video, filepath, settings.remux_format, settings.compress_crf).result()
+            except (RuntimeError, FileNotFoundError) as e:
+                # keep the original video
+                print(f"Could not convert {filepath}: {e}")
+            else:
+                error_msg = self.verify(filepath, duration)
+
+        if error_msg is not None:
+            pathlib.Path(filepath).unlink(missing_ok=True)
+            self.on_failure(job, downloaded_filepath, error_msg)
+            return
+
+        sha256 = self.executor.submit(compute_sha256, filepath).result()
+        self.download_queue.record_verified(job, filepath, sha256)
+        with self.lock:
+            with open(self.checksums_filename, "a", encoding="utf-8") as f:
+                f.write(f"{sha256}  {filepath}\n")
+
+        if self.on_success is not None:
+            self.on_success(job, downloaded_filepath, filepath)
+
+    # Waits for the queued videos to be processed if `wait` is True. Otherwise they are processed next time,
+    # and the threads get a few seconds to finish what they are doing.
+    def close(self, wait=True):
+        if self.executor is None or self.closed.is_set():
+            return
+
+        if not wait:
+            self.closed.set()
+
+        for thread in self.threads:
+            self.work_queue.put(None)
+        stop_time = time.monotonic() + STOP_TIMEOUT_SECONDS
+        for thread in self.threads:
+            thread.join(None if wait else max(stop_time - time.monotonic(), 0))
+
+        self.closed.set()
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
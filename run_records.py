@@ -0,0 +1,144 @@
+import contextlib
+
+RUN_EMBEDS_FULL = "game,category,players"
+# Players are still embedded, fetching every player separately would take far more requests.
+# Their records are interned though, so only one copy of every player is kept.
+RUN_EMBEDS_COMPACT = "players"
+
+class GameRecord:
+    __slots__ = ("id", "name", "abbreviation")
+
+    def __init__(self, game_data):
+        self.id = game_data["id"]
+        self.name = game_data["names"]["international"]
+        self.abbreviation = game_data["abbreviation"]
+
+class CategoryRecord:
+    __slots__ = ("id", "name")
+
+    def __init__(self, category_data):
+        self.id = category_data["id"]
+        self.name = category_data["name"]
+
+class PlayerRecord:
+    __slots__ = ("key", "name", "vod_site_urls")
+
+    def __init__(self, player_data):
+        if player_data["rel"] == "guest":
+            # guests have no id, only a name
+            self.key = player_data.get("name", "")
+            self.name = player_data["name"]
+            self.vod_site_urls = ()
+        else:
+            self.key = player_data["id"]
+            self.name = player_data["names"]["international"]
+            vod_site_urls = []
+            twitch_info = player_data.get("twitch")
+            if twitch_info is not None:
+                vod_site_urls.append(twitch_info["uri"])
+
+            youtube_info = player_data.get("youtube")
+            if youtube_info is not None:
+                vod_site_urls.append(youtube_info["uri"])
+
+            self.vod_site_urls = tuple(vod_site_urls)
+
+# The parts of a run which are used, referencing the shared records of its game, category and players
+class CompactRun:
+    __slots__ = ("id", "game", "category", "level", "values", "players", "time", "time_seconds", "video_urls", "submitted", "date", "comment", "verify_date")
+
+    def __init__(self, run, game, category, players, values):
+        self.id = run["id"]
+        self.game = game
+        self.category = category
+        self.level = run.get("level")
+        self.values = values
+        self.players = players
+        self.time = run["times"]["primary"]
+        self.time_seconds = run["times"].get("primary_t")
+        videos = run.get("videos") or {}
+        self.video_urls = tuple(video.get("uri", "") for video in videos.get("links") or ())
+        self.submitted = run.get("submitted", "Unknown date")
+        self.date = run.get("date", "Unknown date")
+        self.comment = run.get("comment", "")
+        status = run.get("status") or {}
+        self.verify_date = status.get("verify-date")
+
+# Lookup tables of the games, categories and players of the runs of a scrape. In compact mode, runs are fetched
+# without their game and category embedded (which repeats them in every run of a page), and those are fetched
+# once per game instead. Either way, every game, category, player and set of variable values is only kept once.
+class RunTables:
+    __slots__ = ("srcom_client", "compact", "embed", "games", "categories", "players", "values")
+
+    def __init__(self, srcom_client, compact=False):
+        self.srcom_client = srcom_client
+        self.compact = compact
+        self.embed = RUN_EMBEDS_COMPACT if compact else RUN_EMBEDS_FULL
+        self.games = {}
+        self.categories = {}
+        self.players = {}
+        self.values = {}
+
+    async def fetch_game(self, game_id):
+        game_data = (await self.srcom_client.get(f"/games/{game_id}?embed=categories"))["data"]
+        self.games[game_id] = GameRecord(game_data)
+        for category_data in game_data["categories"]["data"]:
+            self.categories[category_data["id"]] = CategoryRecord(category_data)
+
+    async def fetch_category(self, category_id):
+        category_data = (await self.srcom_client.get(f"/categories/{category_id}"))["data"]
+        self.categories[category_id] = CategoryRecord(category_data)
+
+    def intern_game(self, run):
+        game_data = run["game"]["data"]
+        game = self.games.get(game_data["id"])
+        if game is None:
+            game = GameRecord(game_data)
+            self.games[game.id] = game
+
+        return game
+
+    def intern_category(self, run):
+        category_data = run["category"]["data"]
+        category = self.categories.get(category_data["id"])
+        if category is None:
+            category = CategoryRecord(category_data)
+            self.categories[category.id] = category
+
+        return category
+
+    def intern_player(self, player_data):
+        player_key = player_data.get("id") or player_data.get("name", "")
+        player = self.players.get(player_key)
+        if player is None:
+            player = PlayerRecord(player_data)
+            self.players[player_key] = player
+
+        return player
+
+    def intern_values(self, run):
+        values = tuple(sorted((run.get("values") or {}).items()))
+        return self.values.setdefault(values, values)
+
+    def create_run(self, run):
+        if self.compact:
+            game = self.games[run["game"]]
+            category = self.categories[run["category"]]
+        else:
+            game = self.intern_game(run)
+            category = self.intern_category(run)
+
+        players = tuple(self.intern_player(player_data) for player_data in run["players"]["data"])
+        return CompactRun(run, game, category, players, self.intern_values(run))
+
+    # Turns the runs of `run_stream` (as returned by the API with `self.embed`) into CompactRuns
+    async def iter_compact_runs(self, run_stream):
+        async with contextlib.aclosing(run_stream) as runs:
+            async for run in runs:
+                if self.compact:
+                    if run["game"] not in self.games:
+                        await self.fetch_game(run["game"])
+                    if run["category"] not in self.categories:
+                        await self.fetch_category(run["category"])
+
+                yield self.create_run(run)
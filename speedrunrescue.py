@@ -9,6 +9,12 @@ import yt_dlp.postprocessor
 import json
 from datetime import datetime
 import srcomapi
+import download_queue
+import download_scheduler
+import download_stats
+import post_download
+import run_records
+import video_store
 import twitch_integration
 from twitch_integration import twitch_c_v_url_regex, twitch_current_url_regex
 import asyncio
@@ -16,6 +22,11 @@ import pathlib
 import configargparse
 import traceback
 import sys
+import contextlib
+import threading
+import concurrent.futures
+import urllib.parse
+import operator
 
 # Configuration
 BASE_URL = "https://www.speedrun.com/api/v1"
@@ -27,10 +38,10 @@ DOWNLOADS_REMAINING_FILE = "downloads_remaining_mmbn5.json"
 timestamp = time.time()
 jsonData ={}
 
-def get_user_id(username):
+async def get_user_id(srcom_client, username):
     #getting the userid first from their username
     try:
-        data = srcomapi.get(f"/users/{quote(username)}")
+        data = await srcom_client.get(f"/users/{quote(username)}")
         return data['data']['id']
     except KeyError:
         print("Invalid username or API error")
@@ -39,18 +50,20 @@ def get_user_id(username):
         print(f"Network error: {e}")
         return None
 
-def get_game_id(game):
-    data = srcomapi.get(f"/games?abbreviation={game}&max=1&_bulk=yes")
+async def get_game_id(srcom_client, game):
+    data = await srcom_client.get(f"/games?abbreviation={game}&max=1&_bulk=yes")
+    if len(data["data"]) == 0:
+        raise RuntimeError(f"Game \"{game}\" not found on speedrun.com (use the abbreviation from the game's url, e.g. sm64)")
 
     game_id = data["data"][0]["id"]
     return game_id
 
-def get_personal_bests(user_id):
+async def get_personal_bests(srcom_client, user_id):
     run_ids = []
     url = f"/users/{user_id}/personal-bests?embed=game,category"
     try:
         # Fetch all personal bests in a single request
-        data = srcomapi.get(url)
+        data = await srcom_client.get(url)
         # Extract the runs from the response
         if data and 'data' in data:
             for pb in data['data']:
@@ -64,81 +77,230 @@ def get_personal_bests(user_id):
         print(f"Error fetching personal bests: {e}")
         return []
 
-def get_all_runs(user_id):
-    #gettign all runs with pagination in mind.
-    runs = []
-    offset = 0
-    direction = "asc"
-    last_id = ""
+# The API refuses offsets of 10,000 and above
+RUNS_OFFSET_CAP = 10_000
+# how many runs of concurrently paged partitions may wait to be processed
+MAX_BUFFERED_RUNS = 1000
+# how many Twitch urls are looked up with the Twitch API at once while paging through runs
+TWITCH_RESOLVE_BATCH_SIZE = 500
+MAX_PENDING_RESOLVE_BATCHES = 2
+# how long the download workers get to stop when downloading is interrupted
+WORKER_STOP_TIMEOUT_SECONDS = 5
+# how often idle download workers check whether the post download stage queued a video again
+POST_DOWNLOAD_POLL_SECONDS = 1
+
+# Keeps track of how far paging through runs in one direction got
+class RunScan:
+    __slots__ = ("reached_end", "last_run_id")
+
+    def __init__(self):
+        self.reached_end = False
+        self.last_run_id = None
+
+async def iter_runs_in_direction(srcom_client, query, direction, scan, last_id="", embed=run_records.RUN_EMBEDS_FULL):
+    # Yields the runs, and sets `scan.reached_end` if the end of the results was reached before the offset cap.
+    # If `last_id` is given, stops right before the run with that id.
+    endpoint_format = f"/runs?{query}&max=200&offset={{offset}}&status=verified&embed={embed}&direction={direction}&orderby=date"
 
-    while True:
-        url = f"/runs?user={user_id}&max=200&offset={offset}&status=verified&embed=game,category,players&direction={direction}&orderby=date"
-        try:
-            data = srcomapi.get(url)
-            if last_id:
-                found_duplicate = False
-                for index, run in enumerate(data['data']):
+    try:
+        async with contextlib.aclosing(srcom_client.get_pages(endpoint_format, 200, max_offset=RUNS_OFFSET_CAP)) as pages:
+            async for offset, data in pages:
+                print(f"offset: {offset} ({query})")
+                for run in data['data']:
                     if run['id'] == last_id:
-                        runs.extend(data['data'][0:index])
-                        found_duplicate = True
-                        break
-                if found_duplicate:
-                    break
-            runs.extend(data['data'])
-            # Pagination check
-            if data['pagination']['size'] < 200:
-                break
-            offset += 200
-            if offset >= 10_000:
-                if not last_id:
-                    last_id = runs[-1]["id"]
-                    direction = "desc"
-                    offset = 0
-                else:
-                    break
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching runs: {e}")
-            break
-    return runs
-
-def get_all_runs_from_game(game_id):
-    runs = []
-    offset = 0
-    direction = "asc"
-    last_id = ""
-
-    while True:
-        url = f"/runs?game={game_id}&max=200&offset={offset}&status=verified&embed=game,category,players&direction={direction}&orderby=date"
+                        scan.reached_end = True
+                        return
+
+                    scan.last_run_id = run['id']
+                    yield run
+
+                # Pagination check
+                if data['pagination']['size'] < 200:
+                    scan.reached_end = True
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching runs: {e}")
+        scan.reached_end = True
+
+async def iter_all_runs_with_query(srcom_client, query, embed=run_records.RUN_EMBEDS_FULL):
+    #gettign all runs with pagination in mind.
+    # Once the offset cap is hit, page from the other end (direction=desc)
+    # until the last run of the ascending pass shows up again.
+    scan = RunScan()
+    async with contextlib.aclosing(iter_runs_in_direction(srcom_client, query, "asc", scan, embed=embed)) as runs:
+        async for run in runs:
+            yield run
+
+    if scan.reached_end or scan.last_run_id is None:
+        return
+
+    async with contextlib.aclosing(iter_runs_in_direction(srcom_client, query, "desc", RunScan(), last_id=scan.last_run_id, embed=embed)) as runs:
+        async for run in runs:
+            yield run
+
+def iter_all_runs(srcom_client, user_id, embed=run_records.RUN_EMBEDS_FULL):
+    return iter_all_runs_with_query(srcom_client, f"user={user_id}", embed)
+
+def iter_all_runs_from_game(srcom_client, game_id, embed=run_records.RUN_EMBEDS_FULL):
+    return iter_all_runs_with_query(srcom_client, f"game={game_id}", embed)
+
+# For incremental rescans: page through the most recently verified runs first,
+# stopping at the first run verified before `watermark` (the newest verify date of the previous scrape).
+# `scan.reached_end` is only set if all runs since then were seen, and not cut off by the offset cap or an error.
+async def iter_runs_verified_since(srcom_client, query, watermark, scan, embed=run_records.RUN_EMBEDS_FULL):
+    endpoint_format = f"/runs?{query}&max=200&offset={{offset}}&status=verified&embed={embed}&direction=desc&orderby=verify-date"
+
+    try:
+        async with contextlib.aclosing(srcom_client.get_pages(endpoint_format, 200, max_offset=RUNS_OFFSET_CAP)) as pages:
+            async for offset, data in pages:
+                print(f"offset: {offset} ({query}, verified since {watermark})")
+                for run in data['data']:
+                    verify_date = get_run_verify_date(run)
+                    # runs verified before verify dates were recorded have none, and are sorted last
+                    if verify_date is None or verify_date < watermark:
+                        scan.reached_end = True
+                        return
+
+                    yield run
+
+                if data['pagination']['size'] < 200:
+                    scan.reached_end = True
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching runs: {e}")
+
+async def filter_runs(run_stream, run_ids):
+    async with contextlib.aclosing(run_stream) as runs:
+        async for run in runs:
+            if run["id"] in run_ids:
+                yield run
+
+def get_run_verify_date(run):
+    status = run.get("status") or {}
+    return status.get("verify-date")
+
+def load_scrape_state(scrape_state_filename):
+    try:
+        with open(scrape_state_filename, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        print(f"Error reading {scrape_state_filename}, doing a full scrape")
+        return None
+
+def save_scrape_state(scrape_state_filename, newest_verify_date):
+    with open(scrape_state_filename, "w", encoding="utf-8") as f:
+        json.dump({"newest_verify_date": newest_verify_date}, f, indent=4)
+
+def load_previous_highlights(highlights_json_filename):
+    try:
+        with open(highlights_json_filename, "r", encoding="utf-8") as f:
+            highlights = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    # at-risk markers are recomputed when saving
+    for highlight in highlights:
+        highlight["urls"] = [url.replace("*****", "") for url in highlight["urls"]]
+
+    return highlights
+
+def merge_highlights(previous_highlights, new_highlights):
+    highlights_by_run_id = {}
+    for highlight in previous_highlights:
+        # a newly verified run may have beaten the record, and only a full scrape sees all runs to tell
+        highlight.pop("record", None)
+        highlights_by_run_id[highlight["run_id"]] = highlight
+    for highlight in new_highlights:
+        highlights_by_run_id[highlight["run_id"]] = highlight
+
+    return list(highlights_by_run_id.values())
+
+# Splitting a game's runs into partitions which each (hopefully) stay under the offset cap.
+# Partitions are split by category, then by level for per-level categories, then by whether the run was emulated.
+# Only partitions that hit the cap get split further, and a partition that still hits the cap
+# with nothing left to split by falls back to the asc/desc stitch.
+def iter_runs_from_partition(srcom_client, query, remaining_splits, embed=run_records.RUN_EMBEDS_FULL):
+    if len(remaining_splits) == 0:
+        return iter_all_runs_with_query(srcom_client, query, embed)
+
+    return iter_runs_from_splittable_partition(srcom_client, query, remaining_splits, embed)
+
+async def iter_runs_from_splittable_partition(srcom_client, query, remaining_splits, embed):
+    # Checking whether there is a run at the last allowed offset before paging, so that the runs of
+    # a partition which gets split aren't yielded twice
+    try:
+        data = await srcom_client.get(f"/runs?{query}&max=1&offset={RUNS_OFFSET_CAP - 1}&status=verified")
+        hits_offset_cap = len(data["data"]) != 0
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching runs: {e}")
+        hits_offset_cap = False
+
+    if hits_offset_cap:
+        print(f"Partition {query} has too many runs, splitting it further")
+        run_stream = merge_run_streams([
+            iter_runs_from_partition(srcom_client, f"{query}&{split}", remaining_splits[1:], embed)
+            for split in remaining_splits[0]
+        ])
+    else:
+        run_stream = iter_runs_in_direction(srcom_client, query, "asc", RunScan(), embed=embed)
+
+    async with contextlib.aclosing(run_stream) as runs:
+        async for run in runs:
+            yield run
+
+# Yields the runs of all `run_streams`, which are paged through concurrently. A stream
+# waits while MAX_BUFFERED_RUNS runs of all streams haven't been taken yet.
+async def merge_run_streams(run_streams):
+    merged_runs = asyncio.Queue(MAX_BUFFERED_RUNS)
+
+    # None marks the end of a stream
+    async def forward_runs(run_stream):
         try:
-            print(f"offset: {offset}")
-            data = srcomapi.get(url)
-            if last_id:
-                found_duplicate = False
-                for index, run in enumerate(data['data']):
-                    if run['id'] == last_id:
-                        runs.extend(data['data'][0:index])
-                        found_duplicate = True
-                        break
-                if found_duplicate:
-                    break
-            runs.extend(data['data'])
+            async with contextlib.aclosing(run_stream) as runs:
+                async for run in runs:
+                    await merged_runs.put(run)
+        except Exception as e:
+            await merged_runs.put(e)
+        else:
+            await merged_runs.put(None)
 
-            # Pagination check
-            if data['pagination']['size'] < 200:
-                break
-            offset += 200
-            if offset >= 10_000:
-                if not last_id:
-                    last_id = runs[-1]["id"]
-                    direction = "desc"
-                    offset = 0
-                else:
-                    break
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching runs: {e}")
-            break
+    tasks = [asyncio.create_task(forward_runs(run_stream)) for run_stream in run_streams]
+    try:
+        num_running = len(tasks)
+        while num_running > 0:
+            run = await merged_runs.get()
+            if run is None:
+                num_running -= 1
+            elif isinstance(run, Exception):
+                raise run
+            else:
+                yield run
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def iter_all_runs_from_game_partitioned(srcom_client, game_id, embed=run_records.RUN_EMBEDS_FULL):
+    categories = (await srcom_client.get(f"/games/{game_id}/categories"))["data"]
+    emulated_splits = ("emulated=yes", "emulated=no")
+    level_splits = None
+
+    partitions = []
+    for category in categories:
+        if category["type"] == "per-level":
+            if level_splits is None:
+                levels = (await srcom_client.get(f"/games/{game_id}/levels"))["data"]
+                level_splits = tuple(f"level={level['id']}" for level in levels)
+
+            remaining_splits = (level_splits, emulated_splits)
+        else:
+            remaining_splits = (emulated_splits,)
+
+        partitions.append(iter_runs_from_partition(srcom_client, f"game={game_id}&category={category['id']}", remaining_splits, embed))
 
-    return runs
+    print(f"Fetching runs from {len(partitions)} categories")
+    async with contextlib.aclosing(merge_run_streams(partitions)) as runs:
+        async for run in runs:
+            yield run
 
 twitch_url_regex = re.compile(r"(https?:\/\/)?(?:\w+\.)?twitch\.tv\/\S*", re.IGNORECASE)
 
@@ -165,66 +327,194 @@ def filter_live(info):
     # Otherwise, return None to allow the video.
     return None
 
-async def process_runs(runs, client, ignore_links_in_description):
-    #Extract Twitch highlight urls from runs
-    highlights = []
-    all_twitch_urls = []
-    for run in runs:
-        videos = run.get('videos') or {}
-        links = videos.get('links') or []
-        twitch_urls = []
-        if ignore_links_in_description and links:
-            links = [links[-1]]
-        for video in links:
-            uri = video.get('uri', '')
-            result = is_twitch_video_url(uri)
-            if result == IS_TWITCH_VIDEO_URL:
-                twitch_urls.append(uri)
-            elif result == IS_TWITCH_URL_BUT_NOT_TWITCH_VIDEO_URL:
-                print(f"Skipped non-video twitch url {uri}")
-
-        if len(twitch_urls) != 0:
-            player_twitch_yt_urls = []
-            player_datas = run["players"]["data"]
-            player_names = []
-            for player in player_datas:
-                if player["rel"] == "guest":
-                    player_names.append(player["name"])
-                else:
-                    twitch_info = player.get("twitch")
-                    if twitch_info is not None:
-                        player_twitch_yt_urls.append(twitch_info["uri"])
-
-                    youtube_info = player.get("youtube")
-                    if youtube_info is not None:
-                        player_twitch_yt_urls.append(youtube_info["uri"])
-
-                    player_names.append(player["names"]["international"])
-
-            highlight = {
-                'players': player_names,
-                'game': run['game']['data']['names']['international'],
-                'abbreviation': run['game']['data']['abbreviation'],
-                'category': run['category']['data']['name'],
-                'time': run['times']['primary'],
-                'urls': twitch_urls,
-                'run_id': run['id'],
-                'submitted': run.get('submitted', 'Unknown date'),
-                'date': run.get('date', 'Unknown date'),
-                'comment': run.get('comment', '')
-            }
-
-            all_twitch_urls.extend(twitch_urls)
-            if len(player_twitch_yt_urls) != 0:
-                highlight["vod_sites"] = player_twitch_yt_urls
-
-            highlights.append(highlight)
-
-    if client.twitch is not None:
-        await client.fetch_info(all_twitch_urls)
-        client.write_twitch_users_at_risk()
+def get_leaderboard_key(run):
+    return (run.game.id, run.category.id, run.level, run.values)
 
-    return highlights
+def get_run_player_key(run):
+    return tuple(sorted(player.key for player in run.players))
+
+# Returns the keys of the leaderboard of a run and of its player (or team) on the leaderboard,
+# and its time, or None if the run has no time
+def get_run_record_key(run):
+    run_time = run.time_seconds
+    if run_time is None:
+        return None
+
+    leaderboard_key = get_leaderboard_key(run)
+    return leaderboard_key, (leaderboard_key, get_run_player_key(run)), run_time
+
+# The fastest time of every leaderboard, and of every player (or team) on every leaderboard,
+# among the runs added so far. For a whole game, those are the world records and personal bests.
+# Without `world_records`, only personal bests are labeled, e.g. for the runs of a single user,
+# whose fastest run of a leaderboard isn't necessarily its world record
+class RecordTimes:
+    __slots__ = ("world_records", "world_record_times", "personal_best_times")
+
+    def __init__(self, world_records=True):
+        self.world_records = world_records
+        self.world_record_times = {}
+        self.personal_best_times = {}
+
+    def add_run(self, record_key):
+        leaderboard_key, personal_best_key, run_time = record_key
+        if run_time < self.world_record_times.get(leaderboard_key, float("inf")):
+            self.world_record_times[leaderboard_key] = run_time
+
+        if run_time < self.personal_best_times.get(personal_best_key, float("inf")):
+            self.personal_best_times[personal_best_key] = run_time
+
+    # Returns "wr", "pb" or None
+    def get_record(self, record_key):
+        leaderboard_key, personal_best_key, run_time = record_key
+        if self.world_records and run_time <= self.world_record_times[leaderboard_key]:
+            return "wr"
+        elif run_time <= self.personal_best_times[personal_best_key]:
+            return "pb"
+        else:
+            return None
+
+# Scores how important it is to download a video, higher is more important.
+# Videos of channels further over the highlight limit and older videos are more likely to be deleted,
+# and world records and personal bests are more valuable than obsolete runs.
+def get_download_priority(highlight, video_risk_info):
+    priority = DOWNLOAD_PRIORITY_RECORD_SCORES.get(highlight.get("record"), 0)
+    if video_risk_info is not None:
+        total_duration, created_at = video_risk_info
+        if total_duration >= twitch_integration.HIGHLIGHT_LIMIT_SECONDS:
+            priority += 100 * min(total_duration / twitch_integration.HIGHLIGHT_LIMIT_SECONDS, 5)
+
+        if created_at is not None:
+            # +10 per year
+            age_days = (datetime.now(created_at.tzinfo) - created_at).days
+            priority += min(max(age_days, 0) / 36.5, 100)
+
+    return round(priority, 2)
+
+# Returns the highlight of a run (a run_records.CompactRun), or None if the run has no Twitch videos
+def create_highlight(run, ignore_links_in_description):
+    video_urls = run.video_urls
+    twitch_urls = []
+    if ignore_links_in_description and video_urls:
+        video_urls = video_urls[-1:]
+    for uri in video_urls:
+        result = is_twitch_video_url(uri)
+        if result == IS_TWITCH_VIDEO_URL:
+            twitch_urls.append(uri)
+        elif result == IS_TWITCH_URL_BUT_NOT_TWITCH_VIDEO_URL:
+            print(f"Skipped non-video twitch url {uri}")
+
+    if len(twitch_urls) == 0:
+        return None
+
+    player_twitch_yt_urls = [vod_site_url for player in run.players for vod_site_url in player.vod_site_urls]
+    highlight = {
+        'players': [player.name for player in run.players],
+        'game': run.game.name,
+        'abbreviation': run.game.abbreviation,
+        'category': run.category.name,
+        'time': run.time,
+        'urls': twitch_urls,
+        'run_id': run.id,
+        'submitted': run.submitted,
+        'date': run.date,
+        'comment': run.comment
+    }
+
+    if len(player_twitch_yt_urls) != 0:
+        highlight["vod_sites"] = player_twitch_yt_urls
+
+    return highlight
+
+# Looks up the Twitch urls found while paging through runs with the Twitch API in batches of
+# TWITCH_RESOLVE_BATCH_SIZE urls, so that the lookups overlap with paging. Paging waits while
+# MAX_PENDING_RESOLVE_BATCHES batches haven't been looked up yet.
+class TwitchUrlResolver:
+    __slots__ = ("client", "pending_urls", "url_batches", "task")
+
+    def __init__(self, client):
+        self.client = client
+        self.pending_urls = []
+        self.url_batches = asyncio.Queue(MAX_PENDING_RESOLVE_BATCHES)
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while (twitch_urls := await self.url_batches.get()) is not None:
+            await self.client.fetch_batch_info(twitch_urls)
+
+    async def put(self, twitch_urls):
+        put_task = asyncio.ensure_future(self.url_batches.put(twitch_urls))
+        await asyncio.wait((put_task, self.task), return_when=asyncio.FIRST_COMPLETED)
+        if not put_task.done():
+            # the lookups failed, raise their error instead of waiting forever
+            put_task.cancel()
+            self.task.result()
+
+    async def add_urls(self, twitch_urls):
+        self.pending_urls.extend(twitch_urls)
+        if len(self.pending_urls) >= TWITCH_RESOLVE_BATCH_SIZE:
+            await self.put(self.pending_urls)
+            self.pending_urls = []
+
+    # The last batch is looked up along with what only has to be done once: determining which users
+    # are at risk and saving the cache
+    async def finish(self):
+        await self.put(None)
+        await self.task
+        await self.client.fetch_info(self.pending_urls)
+        self.pending_urls = []
+
+    def cancel(self):
+        self.task.cancel()
+
+# Turns the runs (run_records.CompactRuns) into highlights while paging through them, so that only
+# the highlights and not the runs are kept in memory.
+# Returns the highlights, the number of runs and the newest verify date among them (or `newest_verify_date`).
+# Highlights are only labeled as world records or personal bests with `label_records`, since that needs all runs,
+# and only as personal bests without `label_world_records`, since that needs all runs of the leaderboards.
+async def process_run_stream(run_stream, client, ignore_links_in_description, newest_verify_date=None, label_records=True, label_world_records=True):
+    highlights_by_run_id = {}
+    record_keys_by_run_id = {}
+    record_times = RecordTimes(label_world_records)
+    num_runs = 0
+    resolver = TwitchUrlResolver(client) if client.twitch is not None else None
+
+    try:
+        async with contextlib.aclosing(run_stream) as runs:
+            async for run in runs:
+                num_runs += 1
+                verify_date = run.verify_date
+                if verify_date is not None and (newest_verify_date is None or verify_date > newest_verify_date):
+                    newest_verify_date = verify_date
+
+                record_key = get_run_record_key(run) if label_records else None
+                if record_key is not None:
+                    record_times.add_run(record_key)
+
+                highlight = create_highlight(run, ignore_links_in_description)
+                if highlight is None:
+                    continue
+
+                # runs can show up twice if they were verified while paging
+                highlights_by_run_id[highlight["run_id"]] = highlight
+                record_keys_by_run_id[highlight["run_id"]] = record_key
+                if resolver is not None:
+                    await resolver.add_urls(highlight["urls"])
+
+        if resolver is not None:
+            await resolver.finish()
+            client.write_twitch_users_at_risk()
+    finally:
+        if resolver is not None:
+            resolver.cancel()
+
+    for run_id, highlight in highlights_by_run_id.items():
+        record_key = record_keys_by_run_id[run_id]
+        if record_key is not None:
+            record = record_times.get_record(record_key)
+            if record is not None:
+                highlight["record"] = record
+
+    return list(highlights_by_run_id.values()), num_runs, newest_verify_date
 
 def format_date_of_submission(dateobj):
     try:
@@ -237,15 +527,23 @@ def save_highlights(highlights, client, is_game, highlights_filename, remaining_
     #saving all highlights in a formatted way for the user i guess? My hope is I can automate uploads later
     num_at_risk = 0
 
+    priorities = {}
     for highlight in highlights:
         new_twitch_urls = []
         at_risk = False
         for twitch_url in highlight["urls"]:
+            if twitch_url.endswith("*****"):
+                # from a previous scrape when scraping incrementally
+                twitch_url = twitch_url[:-5]
+
             if not is_game:
                 at_risk = True
             else:
                 at_risk = client.is_video_at_risk(twitch_url)
 
+            # the same video can be linked by several runs, it's as important as the most important of them
+            priority = get_download_priority(highlight, client.get_video_risk_info(twitch_url))
+            priorities[twitch_url] = max(priority, priorities.get(twitch_url, priority))
             if at_risk:
                 new_twitch_urls.append(f"{twitch_url}*****")
             else:
@@ -280,7 +578,8 @@ def save_highlights(highlights, client, is_game, highlights_filename, remaining_
     urls = []
     for entry in highlights:
         src_link = f"https://speedrun.com/{entry['abbreviation']}/runs/{entry['run_id']}"
-        urls.extend((url, src_link) for url in entry["urls"])
+        run_seconds = get_run_seconds(entry["time"])
+        urls.extend({"url": url, "src_link": src_link, "priority": priorities[url.replace("*****", "")], "run_seconds": run_seconds} for url in entry["urls"])
 
     with open(remaining_downloads_filename, "w", encoding="utf-8") as f:
         json.dump(urls, f, indent=4)
@@ -340,90 +639,92 @@ class DesiredQuality:
 
         return cls(False, desired_height, fallback_should_increase_quality)
 
-class QualityPostprocessor(yt_dlp.postprocessor.PostProcessor):
+# sort key of the formats of a video
+get_format_height = operator.itemgetter("height")
+
+# Picks the format closest to the desired height. Built once per desired quality and reused for every video.
+# Whether a format is the source is only looked up where it matters, since that is the expensive part.
+class QualityFormatSelector:
     __slots__ = ("desired_height", "fallback_should_increase_quality")
 
     def __init__(self, desired_quality):
-        super(QualityPostprocessor, self).__init__(None)
         self.desired_height = desired_quality.desired_height
         self.fallback_should_increase_quality = desired_quality.fallback_should_increase_quality
 
     @staticmethod
     def is_format_source(quality_format):
         # No hard and fast rule, so test multiple things
-        if "source" in quality_format["format_id"].lower() or "source" in quality_format.get("format_note", "").lower() or "source" in quality_format.get("format", "").lower():
-            return True
-        else:
-            return False
+        return "source" in quality_format["format_id"].lower() or "source" in (quality_format.get("format_note") or "").lower() or "source" in (quality_format.get("format") or "").lower()
 
-    def run(self, info):
+    # `video_formats` are the formats with a video and a height, sorted by height
+    def select_format_id(self, video_formats):
+        is_format_source = QualityFormatSelector.is_format_source
+        desired_height = self.desired_height
         best_height = 0
         best_tbr = 0
         best_format_id = None
-        source_format = None
-        source_format_id = None
-
-        formats_sorted_by_height = sorted(info["formats"], key=lambda x: x.get("height", 0))
-
-        #with open("video_info.json", "w+") as f:
-        #    json.dump(info, f, indent=2)
-        #
-        #with open("formats_sorted_by_height.json", "w+") as f:
-        #    json.dump(formats_sorted_by_height, f, indent=2)
-
-        #print(f"formats_sorted_by_height: {formats_sorted_by_height}")
-        for quality_format in formats_sorted_by_height:
-            if quality_format["vcodec"] == "none":
-                #print(f"Continued {quality_format}")
-                continue
-
-            format_id = quality_format["format_id"]
-            # some videos e.g. https://www.twitch.tv/videos/118628100
-            # have no height associated with some formats
-            # not really sure how to integrate this into the current quality filtering logic, so just skip these for now
-            height = quality_format.get("height")
-            if height is None:
-                continue
 
-            tbr = quality_format["tbr"]
-            is_source = QualityPostprocessor.is_format_source(quality_format)
-
-            if is_source:
-                source_format = quality_format
-
-            #print(f"best_height: {best_height}, height: {height}, self.desired_height: {self.desired_height}, is_source: {is_source}, quality_format: {quality_format}\n\n\n")
-
-            if best_height == 0 or height < self.desired_height:
+        for quality_format in video_formats:
+            height = quality_format["height"]
+            if best_height == 0 or height < desired_height:
                 best_height = height
-                best_tbr = tbr
-                best_format_id = format_id
+                best_tbr = quality_format["tbr"]
+                best_format_id = quality_format["format_id"]
             # edge case for when there are multiple formats with the same height and we have to choose between them
-            elif height == self.desired_height:
+            elif height == desired_height:
                 # if the best height isn't even the desired height yet, then set it so
                 # otherwise, it is, and we need to choose out of the two which to pick
                 # I think this only happens when one is source quality
 
-                if best_height != self.desired_height or is_source:
+                if best_height != desired_height or is_format_source(quality_format):
                     best_height = height
-                    best_tbr = tbr
-                    best_format_id = format_id
+                    best_tbr = quality_format["tbr"]
+                    best_format_id = quality_format["format_id"]
             # only do this logic if we want to fallback to a higher quality
             # if the height we chose doesn't match the desired height
             elif self.fallback_should_increase_quality:
                 # if the current best height is less than the desired height, and we want to fallback to quality higher
                 # edge case to pick the source quality when we meet qualities with the same height
-                if best_height < self.desired_height or (best_height == height and is_source):
+                if best_height < desired_height or (best_height == height and is_format_source(quality_format)):
                     best_height = height
-                    best_tbr = tbr
-                    best_format_id = format_id
+                    best_tbr = quality_format["tbr"]
+                    best_format_id = quality_format["format_id"]
 
         # Sometimes, the source format size can be less than encoded formats at a lower resolution
-        # if this is true for the best format we picked, then choose the source format
-        if source_format is not None and source_format.get("tbr") is not None and best_tbr is not None and source_format["tbr"] < best_tbr:
-            best_format_id = source_format["format_id"]
+        # if this is true for the best format we picked, then choose the source format.
+        # The last source format counts, which is usually the last format, so look for it from the end.
+        if best_tbr is not None:
+            for quality_format in reversed(video_formats):
+                if is_format_source(quality_format):
+                    source_tbr = quality_format["tbr"]
+                    if source_tbr is not None and source_tbr < best_tbr:
+                        best_format_id = quality_format["format_id"]
+                    break
+
+        return best_format_id
+
+    # Returns the chosen video format and all audio-only formats, in their original order
+    def select_formats(self, formats):
+        # some videos e.g. https://www.twitch.tv/videos/118628100
+        # have no height associated with some formats
+        # not really sure how to integrate this into the current quality filtering logic, so just skip these for now
+        video_formats = [quality_format for quality_format in formats if quality_format["vcodec"] != "none" and quality_format.get("height") is not None]
+        # stable, so formats with the same height stay in their original order. yt-dlp lists them sorted already.
+        video_formats.sort(key=get_format_height)
+        best_format_id = self.select_format_id(video_formats)
 
         # include audio format just in case somehow, the best video format has no audio
-        new_formats = [quality_format for quality_format in info["formats"] if quality_format["format_id"] == best_format_id or (quality_format["acodec"] != "none" and quality_format["vcodec"] == "none")]
+        return [quality_format for quality_format in formats if quality_format["format_id"] == best_format_id or (quality_format["acodec"] != "none" and quality_format["vcodec"] == "none")]
+
+class QualityPostprocessor(yt_dlp.postprocessor.PostProcessor):
+    __slots__ = ("format_selector",)
+
+    def __init__(self, desired_quality):
+        super(QualityPostprocessor, self).__init__(None)
+        self.format_selector = QualityFormatSelector(desired_quality)
+
+    def run(self, info):
+        new_formats = self.format_selector.select_formats(info["formats"])
 
         # if we somehow can't find any formats, then just try to download anything
         if len(new_formats) != 0:
@@ -433,11 +734,87 @@ class QualityPostprocessor(yt_dlp.postprocessor.PostProcessor):
 
         return [], info
 
-def download_videos(remaining_downloads_filename, video_folder_name, downloaded_video_info_filename, download_type_str, game_or_username, allow_all, desired_quality, concurrent_fragments):
-    #pathlib.Path(download_folder_name).mkdir(parents=True, exist_ok=True)
-    #downloading videos out of the provided dict using the yt-dlp module.
+# Remembers where the video of the last download was saved, for the post download stage and the video store
+class DownloadedFilePostprocessor(yt_dlp.postprocessor.PostProcessor):
+    __slots__ = ("downloaded_file",)
+
+    def __init__(self):
+        super(DownloadedFilePostprocessor, self).__init__(None)
+        # (filepath, duration, store key)
+        self.downloaded_file = None
 
-    download_info_template = """\
+    def run(self, info):
+        # after_video gets the info of the video, the downloaded file is only in the info of its requested download,
+        # from which the fields it has in common with the video's info are removed
+        requested_downloads = info.get("requested_downloads")
+        if requested_downloads:
+            downloaded_info = {**info, **requested_downloads[-1]}
+            self.downloaded_file = (downloaded_info.get("filepath"), downloaded_info.get("duration"), video_store.get_store_key(downloaded_info))
+
+        return [], info
+
+# The match_filter of the downloaders when using the video store. Skips videos which are already in the store,
+# which is checked once the format is chosen, and remembers their file.
+class VideoStoreFilter:
+    __slots__ = ("video_store", "stored_file")
+
+    def __init__(self, video_store):
+        self.video_store = video_store
+        # (store key, filepath) of the last video which was already in the store
+        self.stored_file = None
+
+    def __call__(self, info, incomplete=False):
+        if incomplete:
+            return None
+
+        reason = filter_live(info)
+        if reason is not None:
+            return reason
+
+        store_key = video_store.get_store_key(info)
+        filepath = self.video_store.get_filepath(store_key)
+        if filepath is None:
+            return None
+
+        self.stored_file = (store_key, filepath)
+        return f"Already downloaded to {filepath}"
+
+class DownloadSettings:
+    __slots__ = ("video_folder_name", "allow_all", "desired_quality", "concurrent_fragments", "num_workers", "per_host_limit", "min_delay", "max_delay", "max_attempts", "probe_workers", "twitch_cache_filename", "twitch_cache_backend", "download_order", "disk_budget", "min_free_space", "rate_limit", "post_download_settings", "segment_padding", "use_video_store")
+
+    def __init__(self, video_folder_name, allow_all, desired_quality, concurrent_fragments, num_workers=1, per_host_limit=None, min_delay=download_scheduler.DEFAULT_MIN_DELAY, max_delay=download_scheduler.DEFAULT_MAX_DELAY, max_attempts=download_scheduler.DEFAULT_MAX_ATTEMPTS, probe_workers=0, twitch_cache_filename=None, twitch_cache_backend="json", download_order=download_queue.ORDER_PRIORITY, disk_budget=None, min_free_space=download_scheduler.DEFAULT_MIN_FREE_SPACE, rate_limit=None, post_download_settings=None, segment_padding=None, use_video_store=False):
+        self.video_folder_name = video_folder_name
+        self.allow_all = allow_all
+        self.desired_quality = desired_quality
+        self.concurrent_fragments = concurrent_fragments
+        self.num_workers = max(1, num_workers)
+        if per_host_limit is None:
+            per_host_limit = self.num_workers
+        self.per_host_limit = max(1, per_host_limit)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        # 0 to not probe videos before downloading them
+        self.probe_workers = probe_workers
+        # Twitch cache used to find dead links without requests while probing
+        self.twitch_cache_filename = twitch_cache_filename
+        self.twitch_cache_backend = twitch_cache_backend
+        self.download_order = download_order
+        # in bytes, None for no limit on the size of the video folder
+        self.disk_budget = disk_budget
+        self.min_free_space = min_free_space
+        # in bytes per second over all downloads, None for no limit
+        self.rate_limit = rate_limit
+        if post_download_settings is None:
+            post_download_settings = post_download.PostDownloadSettings()
+        self.post_download_settings = post_download_settings
+        # in seconds, None to download whole videos instead of only the part with the run
+        self.segment_padding = segment_padding
+        self.use_video_store = use_video_store
+
+DOWNLOAD_PRIORITY_RECORD_SCORES = {"wr": 200, "pb": 100}
+
+DOWNLOAD_INFO_TEMPLATE = """\
 URL: %(original_url)s
 speedrun.com URL: {src_url}
 Channel: %(uploader_id)s
@@ -448,109 +825,580 @@ Description:
 %(description)s
 =========================================================="""
 
-    print_to_file_list = [[download_info_template, downloaded_video_info_filename]]
-
-    ydl_options = {
-        'format': "bestvideo+bestaudio/best",
-        'outtmpl': f'{video_folder_name}/{download_type_str}/{game_or_username}/%(title)s_%(id)s_%(format_id)s.%(ext)s',
-        'noplaylist': True,
-        'match_filter': filter_live, #uses a function to determine if the dead link now links to a stream and accidentially starts to download this instead. Hopefully should skip livestreams
-        "print_to_file": {"after_video": print_to_file_list},
-        'verbose': True, # for debugging stuff
-        'sleep-interval': 5, #so i dont get insta blacklisted by twitch
-        'retries': 1,  # Retry a second time a bit later in case there was simply an issue
-        'retry-delay': 10,  # Wait 10 seconds before retrying
-        'concurrent_fragment_downloads': concurrent_fragments,
-    }
+twitch_timestamp_regex = re.compile(r"(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?", re.IGNORECASE)
 
-    if desired_quality.download_best:
-        quality_postprocessor = None
-    else:
-        quality_postprocessor = QualityPostprocessor(desired_quality)
+# Returns the `t` parameter of a video url (e.g. ?t=1h23m45s or ?t=5025s) in seconds, or None if there is none
+def get_url_timestamp(url):
+    timestamps = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get("t")
+    if not timestamps:
+        return None
+
+    match = twitch_timestamp_regex.fullmatch(timestamps[0].strip())
+    if match is None or not any(match.groups()):
+        return None
+
+    hours, minutes, seconds = (int(group or 0) for group in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+# Returns the (start, end) seconds of the part of a video showing the run, or None if it isn't known
+def get_video_segment(url, run_seconds, padding):
+    if run_seconds is None:
+        return None
+
+    timestamp = get_url_timestamp(url)
+    if timestamp is None:
+        return None
+
+    return max(timestamp - padding, 0), timestamp + run_seconds + padding
+
+def get_run_seconds(run_time):
+    try:
+        return parse_duration(run_time).total_seconds()
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def get_probed_filesize(info):
+    requested_formats = info.get("requested_formats") or (info,)
+    duration = info.get("duration")
+    filesize = 0
+    for requested_format in requested_formats:
+        format_filesize = requested_format.get("filesize") or requested_format.get("filesize_approx")
+        if format_filesize is None:
+            # tbr is in kbit/s
+            tbr = requested_format.get("tbr")
+            if tbr is None or duration is None:
+                return None
+            format_filesize = tbr * 1000 / 8 * duration
+
+        filesize += format_filesize
+
+    return int(filesize)
+
+def get_url_host(url):
+    host = urllib.parse.urlsplit(url if "://" in url else f"https://{url}").netloc.lower()
+    # www.twitch.tv, m.twitch.tv and twitch.tv are all the same site
+    host_parts = host.split(".")
+    return ".".join(host_parts[-2:])
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return "?"
+
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+
+    return f"{num_bytes:.1f}TiB"
+
+# One downloader per thread of the probe pass, since a downloader can't be shared between threads
+class ProbeDownloaders:
+    __slots__ = ("local", "downloaders")
+
+    def __init__(self):
+        self.local = threading.local()
+        self.downloaders = []
+
+# Shared state of the download workers, which take their downloads from the download queue.
+class DownloadPool:
+    __slots__ = ("download_queue", "downloaded_video_info_filename", "download_type_str", "game_or_username", "download_settings", "quality_postprocessor", "lock", "host_semaphores", "stop_event", "stats", "scheduler", "disk_admission", "post_download_stage", "video_store", "video_locks")
+
+    def __init__(self, download_queue, downloaded_video_info_filename, download_type_str, game_or_username, download_settings):
+        self.download_queue = download_queue
+        self.downloaded_video_info_filename = downloaded_video_info_filename
+        self.download_type_str = download_type_str
+        self.game_or_username = game_or_username
+        self.download_settings = download_settings
+        if download_settings.desired_quality.download_best:
+            self.quality_postprocessor = None
+        else:
+            self.quality_postprocessor = QualityPostprocessor(download_settings.desired_quality)
+
+        self.lock = threading.Lock()
+        self.host_semaphores = {}
+        self.video_locks = {}
+        self.stop_event = threading.Event()
+        self.stats = download_stats.DownloadStats(download_settings.num_workers)
+        self.scheduler = download_scheduler.DownloadScheduler(download_settings.min_delay, download_settings.max_delay, download_settings.max_attempts)
+        self.disk_admission = download_scheduler.DiskAdmission(download_settings.video_folder_name, download_settings.disk_budget, download_settings.min_free_space)
+        if download_settings.use_video_store:
+            self.video_store = video_store.VideoStore(download_settings.video_folder_name)
+        else:
+            self.video_store = None
+
+        if download_settings.post_download_settings.is_enabled():
+            checksums_filename = str(pathlib.Path(downloaded_video_info_filename).with_name("checksums.sha256"))
+            self.post_download_stage = post_download.PostDownloadStage(download_settings.post_download_settings, download_queue, checksums_filename, self.handle_verification_error, self.handle_processed_video)
+        else:
+            self.post_download_stage = None
+
+    def get_video_folder_name(self):
+        return f"{self.download_settings.video_folder_name}/{self.download_type_str}/{self.game_or_username}"
+
+    # Only one worker downloads a video at a time, so that the others find it in the video store afterwards
+    def get_video_lock(self, url):
+        match_obj = twitch_current_url_regex.search(url)
+        video_key = match_obj.group(1) if match_obj else url
+        with self.lock:
+            video_lock = self.video_locks.get(video_key)
+            if video_lock is None:
+                video_lock = threading.Lock()
+                self.video_locks[video_key] = video_lock
+
+        return video_lock
+
+    def get_host_semaphore(self, url):
+        host = get_url_host(url)
+        with self.lock:
+            host_semaphore = self.host_semaphores.get(host)
+            if host_semaphore is None:
+                host_semaphore = threading.BoundedSemaphore(self.download_settings.per_host_limit)
+                self.host_semaphores[host] = host_semaphore
+
+        return host_semaphore
+
+    def write_download_info(self, msg):
+        with self.lock:
+            with open(self.downloaded_video_info_filename, "a+") as f:
+                f.write(msg)
+
+    # The options shared by every download of a worker. The per-video download info is set by `download_video`.
+    def create_ydl_options(self, worker_index):
+        download_settings = self.download_settings
+        # with the video store, videos are linked into the folder of the game or user after downloading
+        output_folder_name = self.video_store.folder_name if self.video_store is not None else self.get_video_folder_name()
+        ydl_options = {
+            'format': "bestvideo+bestaudio/best",
+            # segments get their start and end time added
+            'outtmpl': f'{output_folder_name}/%(title)s_%(id)s_%(format_id)s%(section_start&_{{:.0f}}|)s%(section_end&-{{:.0f}}|)s.%(ext)s',
+            'noplaylist': True,
+            'match_filter': filter_live, #uses a function to determine if the dead link now links to a stream and accidentially starts to download this instead. Hopefully should skip livestreams
+            'verbose': True, # for debugging stuff
+            # pacing between videos is done by the download scheduler
+            'retries': 1,  # Retry a second time a bit later in case there was simply an issue
+            'retry_sleep_functions': {"http": lambda n: 10, "fragment": lambda n: 10},  # Wait 10 seconds before retrying
+            'concurrent_fragment_downloads': download_settings.concurrent_fragments,
+        }
+
+        if download_settings.rate_limit is not None:
+            # yt-dlp limits every fragment download on its own, so split the limit between all of them
+            ydl_options["ratelimit"] = download_settings.rate_limit / (download_settings.num_workers * download_settings.concurrent_fragments)
+
+        if worker_index is not None:
+            ydl_options["progress_hooks"] = [lambda progress: self.stats.update_progress(worker_index, progress)]
+            # with several workers, yt-dlp's own progress lines would be interleaved, so show a combined progress line instead
+            if download_settings.num_workers > 1:
+                ydl_options["verbose"] = False
+                ydl_options["noprogress"] = True
+
+        return ydl_options
+
+    def print_progress(self):
+        progress_strs = []
+        for worker_index, worker_progress in enumerate(self.stats.get_worker_progress()):
+            if worker_progress is None:
+                progress_strs.append(f"#{worker_index + 1}: idle")
+                continue
+
+            downloaded_bytes, total_bytes, speed = worker_progress
+            progress_str = f"#{worker_index + 1}: {format_bytes(downloaded_bytes)}/{format_bytes(total_bytes)}"
+            if speed is not None:
+                progress_str += f" at {format_bytes(speed)}/s"
+            progress_strs.append(progress_str)
+
+        num_pending = self.download_queue.count_jobs(download_queue.JOB_PENDING)
+        with self.lock:
+            print(f"Downloads remaining: {num_pending} | {' | '.join(progress_strs)}")
+
+    def write_stats(self, stats_filename):
+        num_pending, pending_bytes, num_pending_unknown_size = self.download_queue.get_pending_filesizes()
+        self.stats.write(stats_filename, num_pending, pending_bytes, num_pending_unknown_size)
+
+    # Every worker keeps one downloader for all of its downloads, so that extractor state,
+    # cookies and HTTP connections are reused instead of being set up again for every video
+    def create_downloader(self, ydl_options, downloaded_file_postprocessor=None):
+        ydl = yt_dlp.YoutubeDL(ydl_options)
+        if self.quality_postprocessor is not None:
+            ydl.add_post_processor(self.quality_postprocessor, when="pre_process")
+        if downloaded_file_postprocessor is not None:
+            ydl.add_post_processor(downloaded_file_postprocessor, when="after_video")
+
+        return ydl
+
+    # Returns None if the video was downloaded, otherwise the error message
+    # `segment` is the (start, end) seconds of the video to download, or None to download all of it
+    def download_video(self, ydl, worker_index, clean_url, src_link, segment=None):
+        # yt-dlp reads these for every video, so they can be changed between downloads
+        ydl.params["print_to_file"] = {"after_video": [[DOWNLOAD_INFO_TEMPLATE.format(src_url=src_link), self.downloaded_video_info_filename]]}
+        if segment is not None:
+            # only the HLS fragments covering the segment are downloaded (through ffmpeg)
+            ydl.params["download_ranges"] = yt_dlp.utils.download_range_func(None, [segment])
+        else:
+            ydl.params.pop("download_ranges", None)
+        self.stats.start_download(worker_index, clean_url)
+        try:
+            ydl.download([clean_url])
+        except Exception as e:
+            self.stats.finish_download(worker_index, False)
+            error_msg = e.args[0] if len(e.args) >= 1 else ""
+            return str(error_msg) or e.__class__.__name__
+
+        self.stats.finish_download(worker_index, True)
+        return None
+
+    # Returns the (start, end) seconds of the job's video to download, or None to download all of it
+    def get_job_segment(self, job):
+        segment_padding = self.download_settings.segment_padding
+        if segment_padding is None:
+            return None
+
+        return get_video_segment(job.url, job.run_seconds, segment_padding)
+
+    # Returns how long the downloaded video of a job should be, or None if unknown
+    def get_expected_duration(self, job, downloaded_duration):
+        segment = self.get_job_segment(job)
+        if segment is None:
+            # the probed duration comes from before the download, so it isn't affected by a broken download
+            return job.duration if job.duration is not None else downloaded_duration
+
+        start, end = segment
+        if job.duration is not None:
+            end = min(end, job.duration)
+
+        return max(end - start, 0)
+
+    def handle_download_error(self, job, error_msg):
+        error_class = download_scheduler.classify_download_error(error_msg)
+        if error_class in (download_scheduler.ERROR_DEAD, download_scheduler.ERROR_LIVE):
+            print(f"Skipping invalid or dead link: {job.url}")
+            self.write_download_info(f"{job.url} for {job.src_link} does not exist\n==========================================================\n")
+            self.download_queue.mark_failed(job, error_msg, error_class)
+            return
+
+        retry_delay = self.scheduler.record_failure(error_class, job.attempts)
+        if retry_delay is None:
+            print(f"Failed to download {job.url} after {job.attempts} attempts: {error_msg}")
+            self.write_download_info(f"Failed to download {job.url}: {error_msg}\n==========================================================\n")
+            self.download_queue.mark_failed(job, error_msg, error_class)
+        else:
+            print(f"Failed to download {job.url} ({error_class} error), retrying in {retry_delay} seconds: {error_msg}")
+            self.download_queue.requeue(job, error_msg, error_class, time.time() + retry_delay)
+
+    # Looks up the metadata of a queued video without downloading it. Dead links and live streams are
+    # taken out of the queue right away, and the size and duration of the other videos are recorded.
+    def probe_job(self, job, probe_downloaders):
+        ydl = getattr(probe_downloaders.local, "ydl", None)
+        if ydl is None:
+            ydl_options = self.create_ydl_options(None)
+            ydl_options["quiet"] = True
+            ydl_options["verbose"] = False
+            ydl = self.create_downloader(ydl_options)
+            probe_downloaders.local.ydl = ydl
+            with self.lock:
+                probe_downloaders.downloaders.append(ydl)
 
-    while True:
         try:
-            # Load URLs from JSON file
-            with open(remaining_downloads_filename, "r", encoding="utf-8") as f:
-                urls = json.load(f)
+            info = ydl.extract_info(job.url, download=False)
+        except Exception as e:
+            error_msg = e.args[0] if len(e.args) >= 1 else ""
+            return str(error_msg) or e.__class__.__name__
+
+        if info is None:
+            # rejected by filter_live
+            return "Skipping live stream"
+        if info.get("is_live"):
+            return "Skipping live stream"
+
+        filesize = get_probed_filesize(info)
+        duration = info.get("duration")
+        segment = self.get_job_segment(job)
+        if segment is not None and filesize is not None and duration:
+            start, end = segment
+            filesize = int(filesize * max(min(end, duration) - start, 0) / duration)
+
+        self.download_queue.record_probe(job, filesize, duration)
+        return None
+
+    def probe_jobs(self):
+        download_settings = self.download_settings
+        jobs = self.download_queue.get_unprobed_jobs(not download_settings.allow_all)
+        if len(jobs) == 0:
+            return
+
+        print(f"Checking {len(jobs)} videos before downloading!")
+        num_dead = 0
+        if download_settings.twitch_cache_filename is not None:
+            # The cache is only read here, on this thread, since the sqlite backend can't be used from the probe threads
+            twitch_cache_store = twitch_integration.create_cache_store(download_settings.twitch_cache_filename, download_settings.twitch_cache_backend)
+            try:
+                user_cache = twitch_integration.UserCache(twitch_cache_store)
+                jobs_to_probe = []
+                for job in jobs:
+                    video_id = user_cache.parse_valid_video_id(job.url)
+                    video_info = user_cache.cache_info["video_infos"].get(video_id) if video_id is not None else None
+                    if video_info is not None and video_info.get("missing"):
+                        self.handle_download_error(job, "Video does not exist (according to the Twitch cache)")
+                        num_dead += 1
+                    else:
+                        jobs_to_probe.append(job)
+            finally:
+                twitch_cache_store.close()
+
+            jobs = jobs_to_probe
+
+        probe_downloaders = ProbeDownloaders()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=download_settings.probe_workers) as executor:
+                for job, error_msg in zip(jobs, executor.map(lambda job: self.probe_job(job, probe_downloaders), jobs)):
+                    if error_msg is None:
+                        continue
+
+                    error_class = download_scheduler.classify_download_error(error_msg)
+                    if error_class in (download_scheduler.ERROR_DEAD, download_scheduler.ERROR_LIVE):
+                        self.handle_download_error(job, error_msg)
+                        num_dead += 1
+                    else:
+                        # leave it to the download itself to retry
+                        print(f"Could not check {job.url}: {error_msg}")
+        finally:
+            for ydl in probe_downloaders.downloaders:
+                ydl.close()
+
+        print(f"Removed {num_dead} dead links or live streams from the downloads")
+
+    # Videos larger than the whole disk budget could never be admitted, and the workers would wait for them forever
+    def fail_oversized_jobs(self):
+        disk_budget = self.download_settings.disk_budget
+        if disk_budget is None:
+            return
+
+        error_msg = f"Video is larger than the disk budget of {disk_budget / 1024 ** 3:g} GB"
+        for job in self.download_queue.fail_jobs_larger_than(disk_budget, error_msg, download_scheduler.ERROR_TOO_LARGE):
+            print(f"Not downloading {job.url}, it is larger than the disk budget ({job.filesize / 1024 ** 3:.1f} GB)")
+            self.write_download_info(f"Failed to download {job.url}: {error_msg}\n==========================================================\n")
+
+    # Returns False if there is nothing left to download
+    def wait_for_retries(self):
+        next_retry_time = self.download_queue.get_next_retry_time()
+        if next_retry_time is None:
+            return False
+
+        if next_retry_time <= time.time():
+            # there are downloads left, but none of them fit on the disk
+            if self.disk_admission.set_paused(True):
+                print("Not enough disk space for the next download, pausing downloads until there is.")
+
+        # check again regularly, since other workers may add retries which are due earlier
+        self.stop_event.wait(min(max(next_retry_time - time.time(), 0), 5))
+        return True
+
+    def handle_verification_error(self, job, filepath, error_msg):
+        if self.video_store is not None:
+            self.video_store.remove_file(filepath)
+
+        retry_delay = self.scheduler.record_failure(download_scheduler.ERROR_TRANSIENT, job.attempts)
+        if retry_delay is None:
+            print(f"Downloaded video of {job.url} is broken, giving up after {job.attempts} attempts: {error_msg}")
+            self.write_download_info(f"Failed to download {job.url}: {error_msg}\n==========================================================\n")
+            self.download_queue.mark_failed(job, error_msg, download_scheduler.ERROR_TRANSIENT)
+        else:
+            print(f"Downloaded video of {job.url} is broken, downloading it again in {retry_delay} seconds: {error_msg}")
+            self.download_queue.requeue(job, error_msg, download_scheduler.ERROR_TRANSIENT, time.time() + retry_delay)
+
+    def handle_processed_video(self, job, filepath, new_filepath):
+        if self.video_store is not None:
+            self.video_store.replace_file(filepath, new_filepath)
+
+    # Links a downloaded video into the folder of the game or user, and queues it for the post download stage
+    def handle_downloaded_video(self, job, filepath, duration, store_key):
+        if self.video_store is not None:
+            self.video_store.link(store_key, filepath, self.get_video_folder_name())
+
+        if self.post_download_stage is not None:
+            self.download_queue.record_downloaded_file(job, filepath, duration)
+            self.post_download_stage.submit(job, filepath, self.get_expected_duration(job, duration))
+
+    def run_worker(self, worker_index):
+        ydl_options = self.create_ydl_options(worker_index)
+        if self.video_store is not None:
+            video_store_filter = VideoStoreFilter(self.video_store)
+            ydl_options["match_filter"] = video_store_filter
+        else:
+            video_store_filter = None
+
+        downloaded_file_postprocessor = DownloadedFilePostprocessor() if self.post_download_stage is not None or self.video_store is not None else None
+        with self.create_downloader(ydl_options, downloaded_file_postprocessor) as ydl:
+            self.run_worker_downloads(ydl, worker_index, downloaded_file_postprocessor, video_store_filter)
 
-            # Stop if no URLs are left
-            if not urls:
-                print("All downloads completed!")
+    def run_worker_downloads(self, ydl, worker_index, downloaded_file_postprocessor, video_store_filter=None):
+        while not self.stop_event.is_set():
+            if not self.scheduler.wait_until_unpaused(self.stop_event):
                 break
 
-            url_info = urls[0]
-            if isinstance(url_info, list):
-                current_url, src_link = url_info
-            else:
-                current_url = url_info
-                src_link = "N/A"
-
-            sleep_time = 15
-            if allow_all or current_url.endswith("*****"):
-                clean_url = current_url.replace("*****", "") # Cleaning up the extraspacing
-                print(f"Downloading: {clean_url}")
-                print_to_file_list[0][0] = download_info_template.format(src_url=src_link)
-                with yt_dlp.YoutubeDL(ydl_options) as ydl:
-                    if quality_postprocessor is not None:
-                        ydl.add_post_processor(quality_postprocessor, when="pre_process")
+            job = self.disk_admission.admit(lambda max_filesize: self.download_queue.claim_next(self.download_settings.download_order, max_filesize))
+            if job is None:
+                if self.wait_for_retries():
+                    continue
+                if self.post_download_stage is not None and self.post_download_stage.is_busy():
+                    # broken downloads found by the checks are downloaded again
+                    self.stop_event.wait(POST_DOWNLOAD_POLL_SECONDS)
+                    continue
+                break
 
+            self.disk_admission.set_paused(False)
+
+            if self.download_settings.allow_all or job.at_risk:
+                print(f"Downloading: {job.url}")
+                stored_file = None
+                downloaded_file = None
+                with self.get_video_lock(job.url), self.get_host_semaphore(job.url):
+                    if downloaded_file_postprocessor is not None:
+                        downloaded_file_postprocessor.downloaded_file = None
+                    if video_store_filter is not None:
+                        video_store_filter.stored_file = None
                     try:
-                        ydl.download([clean_url])
+                        error_msg = self.download_video(ydl, worker_index, job.url, job.src_link, self.get_job_segment(job))
                     except Exception as e:
-                        error_msg = e.args[0] if len(e.args) >= 1 else ""
-                        # Video does not exist
-                        # video_does_not_exist_regex = re.compile(r"Video \w+ does not exist", flags=re.IGNORECASE) <-- seemed not to work. as a quick fix i disabled it and check manually
-                        if ("does not exist" in error_msg) or ("The channel is not currently live" in error_msg):
-                            print(f"Skipping invalid or dead link: {clean_url}")
-                            with open(downloaded_video_info_filename, "a+") as f:
-                                f.write(f"{clean_url} for {src_link} does not exist\n==========================================================\n")
-                            #sleep_time = 15
-
-                        else:
-                            print_exception(e, f"Failed to download {clean_url}: ")
-                            with open(downloaded_video_info_filename, "a+") as f:
-                                f.write(f"Failed to download {clean_url}: {error_msg}\n==========================================================\n")
+                        print_exception(e, "Unexpected error: ")
+                        self.disk_admission.release(job, False)
+                        self.stop_event.set()
+                        break
+
+                    if self.stop_event.is_set():
+                        # the queue and the video store may be closed already. The job is still claimed, so it's
+                        # released with the other claimed jobs, and yt-dlp finds a finished download next time.
+                        self.disk_admission.release(job, False)
+                        break
+
+                    if error_msg is None:
+                        if video_store_filter is not None:
+                            stored_file = video_store_filter.stored_file
+                        if stored_file is None and downloaded_file_postprocessor is not None and downloaded_file_postprocessor.downloaded_file is not None and downloaded_file_postprocessor.downloaded_file[0] is not None:
+                            downloaded_file = downloaded_file_postprocessor.downloaded_file
+                            if self.video_store is not None:
+                                # before releasing the lock, so that other workers don't download it again
+                                filepath, duration, store_key = downloaded_file
+                                self.video_store.add(store_key, filepath)
+
+                self.disk_admission.release(job, error_msg is None and stored_file is None)
+                if error_msg is None:
+                    self.download_queue.mark_done(job)
+                    self.scheduler.record_success()
+                    if stored_file is not None:
+                        store_key, filepath = stored_file
+                        print(f"{job.url} was already downloaded to {filepath}")
+                        self.video_store.link(store_key, filepath, self.get_video_folder_name())
+                    elif downloaded_file is not None:
+                        self.handle_downloaded_video(job, *downloaded_file)
+                else:
+                    self.handle_download_error(job, error_msg)
+
+                sleep_time = self.scheduler.get_delay()
             else:
-                print(f"Skipping {current_url} (not marked as at-risk)")
+                print(f"Skipping {job.url} (not marked as at-risk)")
+                self.disk_admission.release(job, False)
+                self.download_queue.mark_skipped(job)
                 sleep_time = 0
 
-            urls.pop(0)
-            with open(remaining_downloads_filename, "w", encoding="utf-8") as f:
-                json.dump(urls, f, indent=4)
-            if sleep_time != 0:
-                print(f"Waiting {sleep_time} seconds before downloading the next video.")
-                time.sleep(sleep_time)
-        except FileNotFoundError:
-            print("No remaining downloads file found")
-            break
-        except json.JSONDecodeError:
-            print("Error reading JSON file")
-            break
+            if sleep_time != 0 and not self.stop_event.is_set():
+                print(f"Waiting {sleep_time:.0f} seconds before downloading the next video.")
+                self.stop_event.wait(sleep_time)
+
+def get_download_queue_filename(remaining_downloads_filename):
+    return str(pathlib.Path(remaining_downloads_filename).with_suffix(".sqlite3"))
+
+def get_download_stats_filename(remaining_downloads_filename):
+    return str(pathlib.Path(remaining_downloads_filename).with_name("download_stats.json"))
+
+def download_videos(remaining_downloads_filename, downloaded_video_info_filename, download_type_str, game_or_username, download_settings):
+    #pathlib.Path(download_folder_name).mkdir(parents=True, exist_ok=True)
+    #downloading videos out of the provided dict using the yt-dlp module.
+
+    queue = download_queue.DownloadQueue(get_download_queue_filename(remaining_downloads_filename))
+    download_pool = None
+    worker_threads = []
+    try:
+        # picks up any edits made to the remaining downloads file
+        queue.sync_from_remaining_downloads(remaining_downloads_filename)
+        download_pool = DownloadPool(queue, downloaded_video_info_filename, download_type_str, game_or_username, download_settings)
+        if download_settings.probe_workers > 0:
+            download_pool.probe_jobs()
+        # also for sizes probed in earlier runs
+        download_pool.fail_oversized_jobs()
+
+        post_download_stage = download_pool.post_download_stage
+        if post_download_stage is not None:
+            post_download_stage.start()
+            # videos downloaded before the last run was interrupted
+            for job, filepath, duration in queue.get_unverified_jobs():
+                post_download_stage.submit(job, filepath, download_pool.get_expected_duration(job, duration))
+
+        stats_filename = get_download_stats_filename(remaining_downloads_filename)
+        num_workers = download_settings.num_workers
+        # daemon threads, so that Ctrl-C doesn't have to wait for the current downloads to finish
+        worker_threads = [threading.Thread(target=download_pool.run_worker, args=(worker_index,), daemon=True) for worker_index in range(num_workers)]
+        for worker_thread in worker_threads:
+            worker_thread.start()
+
+        try:
+            while any(worker_thread.is_alive() for worker_thread in worker_threads):
+                for worker_thread in worker_threads:
+                    worker_thread.join(timeout=5)
+                    if worker_thread.is_alive():
+                        queue.heartbeat()
+                        download_pool.write_stats(stats_filename)
+                        if num_workers > 1:
+                            download_pool.print_progress()
+                        break
         except KeyboardInterrupt:
+            download_pool.stop_event.set()
+            download_pool.write_stats(stats_filename)
             print("\nDownload interrupted by user. Progress saved.")
-            with open(remaining_downloads_filename, "w", encoding="utf-8") as f:
-                json.dump(urls, f, indent=4)
-            break
-        except Exception as e:
-            print_exception(e, "Unexpected error: ")
-            print(f"Unexpected error: {e}")
-            break
+            return
+
+        download_pool.write_stats(stats_filename)
+        if post_download_stage is not None:
+            num_waiting = post_download_stage.get_num_waiting()
+            if num_waiting != 0:
+                print(f"Waiting for {num_waiting} downloaded videos to be checked...")
+            post_download_stage.close()
+
+        # Stop if no URLs are left
+        if queue.count_jobs(download_queue.JOB_PENDING) == 0:
+            print("All downloads completed!")
+    finally:
+        if download_pool is not None:
+            # the workers are still running if downloading was interrupted, give them a moment to stop using the queue
+            download_pool.stop_event.set()
+            stop_time = time.monotonic() + WORKER_STOP_TIMEOUT_SECONDS
+            for worker_thread in worker_threads:
+                worker_thread.join(max(stop_time - time.monotonic(), 0))
+        if download_pool is not None and download_pool.post_download_stage is not None:
+            # unchecked videos are checked the next time downloads start
+            download_pool.post_download_stage.close(wait=False)
+        if download_pool is not None and download_pool.video_store is not None:
+            download_pool.video_store.close()
+        # a worker stopped by an unexpected error leaves its job claimed
+        queue.release_claimed_jobs()
+        queue.close()
 
 def load_remaining_downloads(remaining_downloads_filename):
-    try:
-        with open(remaining_downloads_filename, "r", encoding="utf-8") as f:
-            urls = json.load(f)
-        if not urls:
-            print("No remaining downloads file found")
-            return None
-        return urls
-    except FileNotFoundError:
+    if not pathlib.Path(remaining_downloads_filename).is_file():
         print("No remaining downloads file found")
-    except json.JSONDecodeError:
-        print("Error reading JSON file")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+        return None
+
+    queue = download_queue.DownloadQueue(get_download_queue_filename(remaining_downloads_filename))
+    try:
+        queue.sync_from_remaining_downloads(remaining_downloads_filename)
+        num_pending = queue.count_jobs(download_queue.JOB_PENDING)
+    finally:
+        queue.close()
+
+    if num_pending == 0:
+        print("No remaining downloads found")
+        return None
+
+    return num_pending
 
 def convert_bool(value):
     value_str_lower = value.lower()
@@ -561,8 +1409,168 @@ def convert_bool(value):
     else:
         raise configargparse.ArgumentTypeError(f"Invalid bool type (must be `true` or `false`, got {value})")
 
-def process_personal_bests(runs, pb_ids):
-    return [run for run in runs if run["id"] in pb_ids]
+def parse_gigabytes(gigabytes):
+    if gigabytes is None:
+        return None
+
+    return int(gigabytes * 1024 ** 3)
+
+def parse_freshness_policies(freshness_policy_strs):
+    freshness_policies = []
+    if freshness_policy_strs is None:
+        return freshness_policies
+
+    for freshness_policy_str in freshness_policy_strs:
+        endpoint_prefix, separator, max_age_str = freshness_policy_str.rpartition("=")
+        if separator == "" or not endpoint_prefix.startswith("/"):
+            raise RuntimeError(f"Invalid format for `srcom-cache-freshness` (got: {freshness_policy_str}). Each entry should be an endpoint followed by = and how long responses from it stay fresh, e.g. /runs=6h or /games=forever.")
+
+        max_age_str = max_age_str.strip()
+        if max_age_str == "forever":
+            max_age = None
+        else:
+            max_age = twitch_integration.parse_duration(max_age_str)
+
+        freshness_policies.append((endpoint_prefix.strip(), max_age))
+
+    return freshness_policies
+
+# A game or user to scrape runs from, with the files for its output
+class ScrapeTarget:
+    __slots__ = ("game_or_username", "is_game", "download_type_str", "highlights_filename", "highlights_json_filename", "remaining_downloads_filename", "downloaded_video_info_filename", "scrape_state_filename")
+
+    def __init__(self, game_or_username, is_game):
+        self.game_or_username = game_or_username
+        self.is_game = is_game
+        self.download_type_str = "game" if is_game else "user"
+
+        base_output_dirpath = pathlib.Path(f"output/{self.download_type_str}/{game_or_username}")
+        base_output_dirpath.mkdir(parents=True, exist_ok=True)
+
+        self.highlights_filename = f"{base_output_dirpath}/twitch_highlights.txt"
+        self.highlights_json_filename = f"{base_output_dirpath}/twitch_highlights.json"
+        self.remaining_downloads_filename = f"{base_output_dirpath}/remaining_downloads.json"
+        self.downloaded_video_info_filename = f"{base_output_dirpath}/download_info.txt"
+        self.scrape_state_filename = f"{base_output_dirpath}/scrape_state.json"
+
+    # e.g. game:sm64 or user:someone
+    @classmethod
+    def from_string(cls, target_str):
+        target_type, sep, game_or_username = target_str.partition(":")
+        target_type = target_type.strip().lower()
+        game_or_username = game_or_username.strip()
+        if sep == "" or game_or_username == "" or target_type not in ("game", "user", "username"):
+            raise RuntimeError(f"Invalid target \"{target_str}\" in `targets:` (must be like game:<game> or user:<username>)")
+
+        return cls(game_or_username, target_type == "game")
+
+def get_targets(args):
+    if args.game and args.username:
+        raise RuntimeError("Only one of `username:` or `game:` must be specified in config.yml!")
+
+    targets = []
+    if args.game:
+        targets.append(ScrapeTarget(args.game, True))
+    elif args.username:
+        targets.append(ScrapeTarget(args.username, False))
+
+    if args.targets:
+        targets.extend(ScrapeTarget.from_string(target_str) for target_str in args.targets)
+
+    if len(targets) == 0:
+        raise RuntimeError("One of `username:`, `game:` or `targets:` must be specified in config.yml!")
+
+    # the same target twice would scrape and download into the same files at the same time
+    target_keys = set()
+    for target in targets:
+        target_key = (target.is_game, target.game_or_username.lower())
+        if target_key in target_keys:
+            raise RuntimeError(f"The {target.download_type_str} \"{target.game_or_username}\" is listed more than once in `game:`, `username:` and `targets:`!")
+        target_keys.add(target_key)
+
+    return targets
+
+# Scrapes the runs of a target and saves its highlights. Returns whether new highlights were found.
+async def scrape_target(target, args, srcom_client, client):
+    previous_highlights = None
+    watermark = None
+    if args.incremental:
+        scrape_state = load_scrape_state(target.scrape_state_filename)
+        previous_highlights = load_previous_highlights(target.highlights_json_filename)
+        if scrape_state is not None and previous_highlights is not None:
+            watermark = scrape_state.get("newest_verify_date")
+        if watermark is None:
+            print("No previous scrape found, doing a full scrape")
+
+    run_tables = run_records.RunTables(srcom_client, args.compact_scrape)
+    embed = run_tables.embed
+    incremental_scan = RunScan() if watermark is not None else None
+    if target.is_game:
+        game = target.game_or_username
+        print(f"Searching for {game}...")
+        game_id = await get_game_id(srcom_client, game)
+        if watermark is not None:
+            print(f"Getting runs verified since {watermark}")
+            run_stream = iter_runs_verified_since(srcom_client, f"game={game_id}", watermark, incremental_scan, embed)
+        else:
+            print(f"Getting all runs")
+            if args.partitioned_scrape:
+                run_stream = iter_all_runs_from_game_partitioned(srcom_client, game_id, embed)
+            else:
+                run_stream = iter_all_runs_from_game(srcom_client, game_id, embed)
+    else:
+        username = target.game_or_username
+        print(f"Searching for {username}...")
+        # Getting the user id first from the username.
+        user_id = await get_user_id(srcom_client, username)
+        if not user_id:
+            print("User not found")
+            return False
+
+        # Fetch all runs from user
+        print("Fetching runs...")
+        if watermark is not None:
+            run_stream = iter_runs_verified_since(srcom_client, f"user={user_id}", watermark, incremental_scan, embed)
+        else:
+            run_stream = iter_all_runs(srcom_client, user_id, embed)
+        if args.save_only_pbs:
+            pb_ids = await get_personal_bests(srcom_client, user_id)
+            run_stream = filter_runs(run_stream, pb_ids)
+            if previous_highlights is not None:
+                previous_highlights = [highlight for highlight in previous_highlights if highlight["run_id"] in pb_ids]
+
+    # Checking for highlights while the runs are fetched
+    # only newly verified runs are seen when scraping incrementally, so they can't be compared to the records,
+    # and the runs of a user can't tell whether their fastest run of a leaderboard is its world record
+    new_highlights, num_runs, newest_verify_date = await process_run_stream(run_tables.iter_compact_runs(run_stream), client, args.ignore_links_in_description, watermark, label_records=watermark is None, label_world_records=target.is_game)
+
+    if watermark is not None:
+        print(f"Found {num_runs} newly verified runs")
+    else:
+        print(f"Found {num_runs} verified runs")
+
+    print(f"Found {len(new_highlights)} Twitch highlights")
+
+    # Save highlights. All of them go into the remaining downloads, since the download queue drops pending
+    # downloads which aren't listed there anymore, and keeps finished ones finished.
+    if watermark is not None:
+        highlights = merge_highlights(previous_highlights, new_highlights)
+    else:
+        highlights = new_highlights
+
+    save_highlights(highlights, client, target.is_game, target.highlights_filename, target.remaining_downloads_filename, target.highlights_json_filename)
+
+    print(f"Saved highlights to {target.highlights_filename}")
+    if incremental_scan is not None and not incremental_scan.reached_end:
+        # moving the watermark past runs which weren't seen would lose them for good
+        print(f"Warning: Could not get all runs verified since {watermark} (more than {RUNS_OFFSET_CAP} of them, or an error), so some may be missing. The time of the last scrape is left as it was; delete {target.scrape_state_filename} to do a full scrape.")
+    elif newest_verify_date is not None:
+        save_scrape_state(target.scrape_state_filename, newest_verify_date)
+
+    return len(new_highlights) != 0
+
+def download_target_videos(target, download_settings):
+    download_videos(target.remaining_downloads_filename, target.downloaded_video_info_filename, target.download_type_str, target.game_or_username, download_settings)
 
 async def main():
     ap = configargparse.ArgumentParser(
@@ -586,81 +1594,103 @@ async def main():
     ap.add_argument("--ignore-links-in-description", dest="ignore_links_in_description", type=convert_bool, help="Whether to ignore twitch links that are in the video description or not. By default this is disabled.", required=True)
     ap.add_argument("--concurrent-fragments", dest="concurrent_fragments", type=int, help="How many concurrent fragments to download of a video. By default this is 1.")
     ap.add_argument("--safe-only-pbs", dest="save_only_pbs", type=convert_bool,help="If set to true, only the PBs of the runner or all PBs on the leaderboard are being saved.",required=True)
+    ap.add_argument("--srcom-pages-in-flight", dest="srcom_pages_in_flight", type=int, default=srcomapi.DEFAULT_PAGES_IN_FLIGHT, help=f"How many pages of runs to request from speedrun.com ahead of the one currently being processed. Requests are still rate limited. Default is {srcomapi.DEFAULT_PAGES_IN_FLIGHT}.")
+    ap.add_argument("--partitioned-scrape", dest="partitioned_scrape", type=convert_bool, default=False, help="For games, whether to fetch runs category by category (splitting further by level and emulator use where needed) instead of in one list. Needed for leaderboards with more than 20,000 runs, and lets categories be fetched concurrently. By default this is disabled.")
+    ap.add_argument("--compact-scrape", dest="compact_scrape", type=convert_bool, default=False, help="Whether to fetch runs without their game and category, and fetch those once per game instead. Makes the responses of speedrun.com a lot smaller. By default this is disabled.")
+    ap.add_argument("--incremental", dest="incremental", type=convert_bool, default=False, help="Whether to only fetch runs verified since the last scrape of the same game or user, adding them to the existing highlights. Only the new runs are queued for download. By default this is disabled.")
+    ap.add_argument("--srcom-cache-backend", dest="srcom_cache_backend", choices=("files", "sqlite"), default="files", help="How to store cached speedrun.com responses. `files` stores one file per response in the folder srcom_cached, `sqlite` stores all responses compressed in a single file (see `srcom-cache-filename:`). Default is files.")
+    ap.add_argument("--srcom-cache-filename", dest="srcom_cache_filename", default="srcom_cache.sqlite3", help="File to store cached speedrun.com responses in if `srcom-cache-backend:` is sqlite. Default is srcom_cache.sqlite3")
+    ap.add_argument("--srcom-cache-ttl", dest="srcom_cache_ttl", default=None, help="How long to keep cached speedrun.com responses before fetching them again, e.g. 12h, 30m, 168h. By default, cached responses are kept forever.")
+    ap.add_argument("--srcom-cache-max-size", dest="srcom_cache_max_size", type=int, default=None, help="Maximum size of the speedrun.com cache in megabytes, when `srcom-cache-backend:` is sqlite. The least recently used responses are removed first. By default there is no limit.")
+    ap.add_argument("--srcom-cache-freshness", dest="srcom_cache_freshness", action="append", default=None, help="How long cached responses from a speedrun.com endpoint stay fresh, as a list of entries like /runs=6h or /games=forever. Stale responses are checked with speedrun.com again before being used. Endpoints which aren't listed are always taken from the cache.")
+    ap.add_argument("--twitch-concurrency", dest="twitch_concurrency", type=int, default=twitch_integration.DEFAULT_TWITCH_CONCURRENCY, help=f"How many Twitch channels to fetch video lists for at the same time. Default is {twitch_integration.DEFAULT_TWITCH_CONCURRENCY}.")
+    ap.add_argument("--twitch-cache-backend", dest="twitch_cache_backend", choices=("json", "sqlite"), default="json", help="How to store the Twitch cache. `json` keeps it in the file given by `cache-filename:` and rewrites it on every save. `sqlite` keeps it in a database next to it (twitch_cache.sqlite3 for twitch_cache.json), only writing what changed, and imports the json cache the first time. Default is json.")
+    ap.add_argument("--twitch-cache-max-age", dest="twitch_cache_max_age", default=None, help="How long cached Twitch highlight information about a channel is used before checking the channel again, e.g. 168h. Only new and deleted highlights are fetched when checking again. By default, cached channel information is used forever.")
+    ap.add_argument("--download-workers", dest="download_workers", type=int, default=1, help="How many videos to download at the same time. By default this is 1.")
+    ap.add_argument("--per-host-downloads", dest="per_host_downloads", type=int, default=None, help="How many videos to download from the same site (e.g. twitch.tv) at the same time. By default this is the same as `download-workers:`.")
+    ap.add_argument("--download-delay", dest="download_delay", type=float, default=download_scheduler.DEFAULT_MIN_DELAY, help=f"How many seconds to wait between downloads while Twitch isn't throttling downloads. Default is {download_scheduler.DEFAULT_MIN_DELAY}.")
+    ap.add_argument("--max-download-delay", dest="max_download_delay", type=float, default=download_scheduler.DEFAULT_MAX_DELAY, help=f"The longest time in seconds to wait between downloads after Twitch throttled downloads. Default is {download_scheduler.DEFAULT_MAX_DELAY}.")
+    ap.add_argument("--download-attempts", dest="download_attempts", type=int, default=download_scheduler.DEFAULT_MAX_ATTEMPTS, help=f"How many times to try downloading a video before giving up on it. Dead links are never retried. Default is {download_scheduler.DEFAULT_MAX_ATTEMPTS}.")
+    ap.add_argument("--download-order", dest="download_order", choices=(download_queue.ORDER_PRIORITY, download_queue.ORDER_QUEUE, download_queue.ORDER_SMALLEST_FIRST, download_queue.ORDER_AT_RISK_FIRST), default=download_queue.ORDER_PRIORITY, help="In which order to download videos. `priority` downloads the most important videos first (world records and personal bests, channels far over the highlight limit, old videos), `queue` downloads them in the order they were found, `smallest-first` downloads the smallest videos first (their sizes are only known with `probe-workers:`), and `at-risk-first` downloads videos of channels above the highlight limit first. Default is priority.")
+    ap.add_argument("--disk-budget", dest="disk_budget", type=float, default=None, help="The maximum size of the videos in `video-folder-name:` in gigabytes. Downloads which would exceed it (according to the sizes found with `probe-workers:`) are paused. By default there is no limit.")
+    ap.add_argument("--min-free-space", dest="min_free_space", type=float, default=1, help="How many gigabytes to always leave free on the disk with the video folder. Downloads which would use up this space are paused until space is freed. Default is 1.")
+    ap.add_argument("--download-rate-limit", dest="download_rate_limit", type=float, default=None, help="The maximum download speed of all downloads together in megabytes per second. By default there is no limit.")
+    ap.add_argument("--probe-workers", dest="probe_workers", type=int, default=0, help="If above 0, check this many videos at a time for dead links, live streams and their size before starting to download. By default this is 0 (don't check).")
+    ap.add_argument("--verify-downloads", dest="verify_downloads", type=convert_bool, default=False, help="Whether to check downloaded videos with ffprobe and compute their checksums. Videos which can't be read or are shorter than they should be are downloaded again. Checksums are written to checksums.sha256 in the output folder. By default this is disabled.")
+    ap.add_argument("--remux-format", dest="remux_format", choices=("mp4", "mkv"), default=None, help="Container to convert downloaded videos to with ffmpeg, without re-encoding. By default videos are kept as downloaded.")
+    ap.add_argument("--compress-crf", dest="compress_crf", type=int, default=None, help="If given, re-encode downloaded videos with ffmpeg (H.264) at this CRF, e.g. 23. Higher is smaller but worse quality. This is slow. By default videos are not re-encoded.")
+    ap.add_argument("--post-download-workers", dest="post_download_workers", type=int, default=1, help="How many downloaded videos to check, convert and checksum at the same time. This happens while the next videos download. Default is 1.")
+    ap.add_argument("--download-segments", dest="download_segments", type=convert_bool, default=False, help="Whether to only download the part of a video with the run, if the video link has a timestamp (like ?t=1h23m45s). The part starts at the timestamp and is as long as the run's time, plus `segment-padding:`. Needs ffmpeg. By default whole videos are downloaded.")
+    ap.add_argument("--segment-padding", dest="segment_padding", type=float, default=60, help="How many seconds to download before and after the run with `download-segments:`. Default is 60.")
+    ap.add_argument("--video-store", dest="video_store", type=convert_bool, default=False, help="Whether to download every video only once, into a shared folder \"store\" in `video-folder-name:`, and hardlink it into the folders of the games and users linking it. By default every game and user gets its own copy.")
+    ap.add_argument("--targets", dest="targets", action="append", default=None, help="Several games and users to process in one run, as a list of entries like game:sm64 or user:someone. They share the speedrun.com and Twitch connections and caches. Can be used instead of or in addition to `game:`/`username:`.")
+    ap.add_argument("--target-concurrency", dest="target_concurrency", type=int, default=4, help="How many of the `targets:` to scrape at the same time. Requests to speedrun.com and Twitch are still rate limited, and identical requests are only made once. Default is 4.")
     args = ap.parse_args()
 
     desired_quality = DesiredQuality.from_string(args.video_quality)
 
     print(f"Using quality: {args.video_quality}")
 
-    if args.game and args.username:
-        raise RuntimeError("Only one of `username:` or `game:` must be specified in config.yml!")
-
-    game = args.game
-    username = args.username
-    if game:
-        download_type_str = "game"
-        game_or_username = game
-        is_game = True
-    elif not username:
-        raise RuntimeError("One of `username:` or `game:` must be specified in config.yml!")
-    else:
-        download_type_str = "user"
-        game_or_username = username
-        is_game = False
-
-    base_output_dirpath = pathlib.Path(f"output/{download_type_str}/{game_or_username}")
-    base_output_dirpath.mkdir(parents=True, exist_ok=True)
-
-    highlights_filename = f"{base_output_dirpath}/twitch_highlights.txt"
-    highlights_json_filename = f"{base_output_dirpath}/twitch_highlights.json"
-    remaining_downloads_filename = f"{base_output_dirpath}/remaining_downloads.json"
-    downloaded_video_info_filename = f"{base_output_dirpath}/download_info.txt"
+    targets = get_targets(args)
+    if (args.app_id is None or args.app_secret is None) and any(target.is_game for target in targets):
+        raise RuntimeError("Twitch integration must be present if you are requesting a game to be downloaded")
 
     concurrent_fragments = args.concurrent_fragments or 1
-
-    #Check if there are remaining Downloads left.
-    remaininDownloads = load_remaining_downloads(remaining_downloads_filename)
-    if remaininDownloads and input("A remaining downloads file has been found. Do you want to continue the download? (y/n): ").lower().startswith("y"):
-        download_videos(remaining_downloads_filename, args.video_folder_name, downloaded_video_info_filename, download_type_str, game_or_username, args.allow_all, desired_quality, concurrent_fragments)
-        return
-
-    if is_game:
-        print(f"Searching for {game}...")
-        game_id = get_game_id(game)
-        print(f"Getting all runs")
-        runs = get_all_runs_from_game(game_id)
-    else:
-        print(f"Searching for {username}...")
-        # Getting the user id first from the username.
-        user_id = get_user_id(username)
-        if not user_id:
-            print("User not found")
+    download_settings = DownloadSettings(args.video_folder_name, args.allow_all, desired_quality, concurrent_fragments, args.download_workers, args.per_host_downloads, args.download_delay, args.max_download_delay, args.download_attempts, args.probe_workers, args.cache_filename, args.twitch_cache_backend,
+        args.download_order, parse_gigabytes(args.disk_budget), parse_gigabytes(args.min_free_space),
+        int(args.download_rate_limit * 1024 ** 2) if args.download_rate_limit else None,
+        post_download.PostDownloadSettings(args.verify_downloads, args.remux_format, args.compress_crf, args.post_download_workers),
+        args.segment_padding if args.download_segments else None, args.video_store)
+
+    if len(targets) == 1:
+        target = targets[0]
+        #Check if there are remaining Downloads left.
+        remaininDownloads = load_remaining_downloads(target.remaining_downloads_filename)
+        if remaininDownloads and input("A remaining downloads file has been found. Do you want to continue the download? (y/n): ").lower().startswith("y"):
+            download_target_videos(target, download_settings)
             return
 
-        # Fetch all runs from user
-        print("Fetching runs...")
-        runs = get_all_runs(user_id)
-        if args.save_only_pbs:
-            pb_ids = get_personal_bests(user_id)
-            runs = process_personal_bests(runs, pb_ids)
+    srcom_cache_settings = srcomapi.CacheSettings(
+        True, True, "srcom_cached", True,
+        backend=args.srcom_cache_backend,
+        cache_filename=args.srcom_cache_filename,
+        ttl=twitch_integration.parse_duration(args.srcom_cache_ttl) if args.srcom_cache_ttl else None,
+        max_size=args.srcom_cache_max_size * 1024 * 1024 if args.srcom_cache_max_size else None,
+        freshness_policies=parse_freshness_policies(args.srcom_cache_freshness)
+    )
+    # shared by all targets, so that the Twitch token and the caches are only set up once
+    srcom_client = srcomapi.SrcomClient(srcom_cache_settings, pages_in_flight=args.srcom_pages_in_flight)
+    try:
+        client = await twitch_integration.TwitchClient.init(args)
+        try:
+            semaphore = asyncio.Semaphore(max(1, args.target_concurrency))
 
-    print(f"Found {len(runs)} verified runs")
+            async def scrape_target_when_ready(target):
+                async with semaphore:
+                    try:
+                        return await scrape_target(target, args, srcom_client, client)
+                    except Exception as e:
+                        if len(targets) == 1:
+                            raise
 
-    if (args.app_id is None or args.app_secret is None) and is_game:
-        raise RuntimeError("Twitch integration must be present if you are requesting a game to be downloaded")
-    client = await twitch_integration.TwitchClient.init(args)
-    # Checking for highlights
-    highlights = await process_runs(runs, client, args.ignore_links_in_description)
-    print(f"Found {len(highlights)} Twitch highlights")
+                        # one broken target (e.g. a mistyped game) shouldn't stop the others
+                        print_exception(e, f"Failed to scrape the {target.download_type_str} {target.game_or_username}, continuing with the other targets: ")
+                        return False
 
-    # Save highlights
-    save_highlights(highlights, client, is_game, highlights_filename, remaining_downloads_filename, highlights_json_filename)
-    print(f"Saved highlights to {highlights_filename}")
+            targets_have_new_highlights = await asyncio.gather(*(scrape_target_when_ready(target) for target in targets))
+        finally:
+            client.close()
+    finally:
+        srcom_client.close()
+        srcom_cache_settings.close()
 
     # Download prompt for users and downloading videos
-    if highlights and args.download_videos:
-        download_videos(remaining_downloads_filename, args.video_folder_name, downloaded_video_info_filename, download_type_str, game_or_username, args.allow_all, desired_quality, concurrent_fragments)
-        print("Download completed")
+    if args.download_videos:
+        for target, has_new_highlights in zip(targets, targets_have_new_highlights):
+            # nobody is asked whether to continue earlier downloads of a batch, so they always are
+            if has_new_highlights or (len(targets) > 1 and load_remaining_downloads(target.remaining_downloads_filename)):
+                download_target_videos(target, download_settings)
+                print("Download completed")
 
 if __name__ == "__main__":
     try:
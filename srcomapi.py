@@ -1,20 +1,63 @@
 import traceback
 import requests
+import requests.adapters
+import asyncio
+import collections
 import urllib
 import pathlib
 import json
 import time
 import re
 import sys
+import sqlite3
+import os
+import threading
+import zlib
 
 class CacheSettings:
-    __slots__ = ("read_cache", "write_cache", "cache_dirname", "rate_limit", "retry_on_empty")
+    __slots__ = ("read_cache", "write_cache", "cache_dirname", "rate_limit", "retry_on_empty", "backend", "cache_filename", "ttl", "max_size", "freshness_policies", "response_cache")
 
-    def __init__(self, read_cache, write_cache, cache_dirname, rate_limit):
+    def __init__(self, read_cache, write_cache, cache_dirname, rate_limit, backend="files", cache_filename="srcom_cache.sqlite3", ttl=None, max_size=None, freshness_policies=None):
         self.read_cache = read_cache
         self.write_cache = write_cache
         self.cache_dirname = cache_dirname
         self.rate_limit = rate_limit
+        self.backend = backend
+        self.cache_filename = cache_filename
+        # seconds after which cached responses are thrown away, None to keep them forever
+        self.ttl = ttl
+        # bytes of compressed responses to keep (sqlite backend only), None for no limit
+        self.max_size = max_size
+        # (endpoint prefix, max age in seconds or None for forever) pairs. Cached responses
+        # older than the max age of the longest matching prefix are revalidated before use.
+        # Endpoints matching no prefix are always served from the cache.
+        if freshness_policies is None:
+            freshness_policies = ()
+        self.freshness_policies = sorted(freshness_policies, key=lambda x: len(x[0]), reverse=True)
+        self.response_cache = None
+
+    def get_max_age(self, endpoint):
+        for endpoint_prefix, max_age in self.freshness_policies:
+            if endpoint.startswith(endpoint_prefix):
+                return max_age
+
+        return None
+
+    def get_response_cache(self):
+        if self.response_cache is None:
+            if self.backend == "files":
+                self.response_cache = FileResponseCache(self.cache_dirname, self.ttl)
+            elif self.backend == "sqlite":
+                self.response_cache = SqliteResponseCache(self.cache_filename, self.ttl, self.max_size)
+            else:
+                raise RuntimeError(f"Unknown speedrun.com cache backend \"{self.backend}\" (must be `files` or `sqlite`)")
+
+        return self.response_cache
+
+    def close(self):
+        if self.response_cache is not None:
+            self.response_cache.close()
+            self.response_cache = None
 
 default_cache_settings = CacheSettings(True, True, "srcom_cached", True)
 
@@ -23,6 +66,159 @@ def get_cached_endpoint_filepath(endpoint, params, cache_settings):
 
     return pathlib.Path(endpoint_as_pathname)
 
+class CachedResponse:
+    __slots__ = ("data", "status", "fetched_at", "etag", "last_modified")
+
+    def __init__(self, data, status, fetched_at, etag=None, last_modified=None):
+        self.data = data
+        self.status = status
+        self.fetched_at = fetched_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self, max_age):
+        return max_age is None or self.fetched_at + max_age >= time.time()
+
+    def get_revalidation_headers(self):
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        return headers
+
+# One json file per endpoint+query under `cache_dirname`.
+# There is nowhere to keep ETag/Last-Modified, so stale files are always refetched in full.
+class FileResponseCache:
+    __slots__ = ("cache_dirname", "ttl")
+
+    def __init__(self, cache_dirname, ttl):
+        self.cache_dirname = cache_dirname
+        self.ttl = ttl
+
+    def get_filepath(self, endpoint, params):
+        return pathlib.Path(f"{self.cache_dirname}/{urllib.parse.quote(endpoint, safe='')}_q_{urllib.parse.urlencode(params, doseq=True)}.json")
+
+    def get(self, endpoint, params):
+        endpoint_as_path = self.get_filepath(endpoint, params)
+        try:
+            endpoint_as_path_stat = endpoint_as_path.stat()
+        except FileNotFoundError:
+            return None
+
+        if self.ttl is not None and endpoint_as_path_stat.st_mtime + self.ttl < time.time():
+            return None
+
+        if endpoint_as_path_stat.st_size == 0:
+            return CachedResponse({}, 404, endpoint_as_path_stat.st_mtime)
+
+        #print(f"endpoint_as_path: {endpoint_as_path}")
+        with open(endpoint_as_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        return CachedResponse(data, 200, endpoint_as_path_stat.st_mtime)
+
+    def mark_revalidated(self, endpoint, params):
+        os.utime(self.get_filepath(endpoint, params))
+
+    def put(self, endpoint, params, data, status=200, etag=None, last_modified=None):
+        endpoint_as_path = self.get_filepath(endpoint, params)
+        endpoint_as_path.parent.mkdir(parents=True, exist_ok=True)
+        data_as_str = json.dumps(data, separators=(",", ":"))
+        with open(endpoint_as_path, "w+", encoding="utf-8") as f:
+            f.write(data_as_str)
+
+    def close(self):
+        pass
+
+# All responses in a single sqlite database, keyed by endpoint+query, with zlib compressed bodies.
+# Entries older than `ttl` are dropped, and the least recently used entries are evicted
+# once the compressed bodies take up more than `max_size` bytes.
+class SqliteResponseCache:
+    __slots__ = ("connection", "lock", "ttl", "max_size", "total_size")
+
+    def __init__(self, cache_filename, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # only ever used under self.lock
+        self.connection = sqlite3.connect(cache_filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, status INTEGER NOT NULL, body BLOB NOT NULL, size INTEGER NOT NULL, fetched_at REAL NOT NULL, last_used_at REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used_at ON responses (last_used_at)")
+            columns = frozenset(row[1] for row in self.connection.execute("PRAGMA table_info(responses)"))
+            if "etag" not in columns:
+                self.connection.execute("ALTER TABLE responses ADD COLUMN etag TEXT")
+                self.connection.execute("ALTER TABLE responses ADD COLUMN last_modified TEXT")
+            if ttl is not None:
+                self.connection.execute("DELETE FROM responses WHERE fetched_at < ?", (time.time() - ttl,))
+
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def get_key(endpoint, params):
+        return f"{endpoint}_q_{urllib.parse.urlencode(params, doseq=True)}"
+
+    def get(self, endpoint, params):
+        key = SqliteResponseCache.get_key(endpoint, params)
+        with self.lock:
+            row = self.connection.execute("SELECT status, body, fetched_at, etag, last_modified FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            status, body, fetched_at, etag, last_modified = row
+            cur_time = time.time()
+            if self.ttl is not None and fetched_at + self.ttl < cur_time:
+                return None
+
+            with self.connection:
+                self.connection.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (cur_time, key))
+
+        return CachedResponse(json.loads(zlib.decompress(body)), status, fetched_at, etag, last_modified)
+
+    def mark_revalidated(self, endpoint, params):
+        key = SqliteResponseCache.get_key(endpoint, params)
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE responses SET fetched_at = ? WHERE key = ?", (time.time(), key))
+
+    def put(self, endpoint, params, data, status=200, etag=None, last_modified=None):
+        key = SqliteResponseCache.get_key(endpoint, params)
+        body = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        cur_time = time.time()
+        with self.lock:
+            with self.connection:
+                old_row = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                if old_row is not None:
+                    self.total_size -= old_row[0]
+
+                self.connection.execute("INSERT OR REPLACE INTO responses (key, status, body, size, fetched_at, last_used_at, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key, status, body, len(body), cur_time, cur_time, etag, last_modified))
+                self.total_size += len(body)
+                if self.max_size is not None and self.total_size > self.max_size:
+                    self.evict()
+
+    # must be called with self.lock held and inside a transaction
+    def evict(self):
+        cursor = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used_at")
+        evicted_keys = []
+        # evict a bit more than needed, so that we don't evict on every single write once full
+        target_size = self.max_size * 0.9
+        for key, size in cursor:
+            if self.total_size <= target_size:
+                break
+            evicted_keys.append((key,))
+            self.total_size -= size
+
+        cursor.close()
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
 API_URL = "https://www.speedrun.com/api/v1"
 
 def get(endpoint, params=None, cache_settings=None, require_success=False):
@@ -38,6 +234,62 @@ def get(endpoint, params=None, cache_settings=None, require_success=False):
             if exception_sleep_time > 1000:
                 exception_sleep_time = 1000
 
+def read_cached_response(endpoint, params, cache_settings):
+    if not cache_settings.read_cache:
+        return None
+
+    return cache_settings.get_response_cache().get(endpoint, params)
+
+def write_cached_response(endpoint, params, data, cache_settings, headers=None):
+    if not cache_settings.write_cache:
+        return
+
+    if headers is None:
+        headers = {}
+
+    response_cache = cache_settings.get_response_cache()
+    exit_after_write = False
+    while True:
+        try:
+            response_cache.put(endpoint, params, data, etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+            break
+        except KeyboardInterrupt:
+            print("Saving speedrun.com API cache, please stop Ctrl-C'ing")
+            exit_after_write = True
+
+    if exit_after_write:
+        sys.exit(1)
+
+def get_fresh_cached_response(endpoint, params, cache_settings):
+    # Returns (data, status) if the cache can be used as is, otherwise the stale
+    # cached response to revalidate (or None if nothing is cached)
+    cached_response = read_cached_response(endpoint, params, cache_settings)
+    if cached_response is None:
+        return None, None
+
+    if cached_response.is_fresh(cache_settings.get_max_age(endpoint)):
+        return (cached_response.data, cached_response.status), None
+
+    return None, cached_response
+
+def get_revalidated_response(endpoint, params, cache_settings, r, stale_response):
+    # Returns (data, status) if the server says the stale response is still good, otherwise None
+    if r.status_code != 304 or stale_response is None:
+        return None
+
+    print("Cached response is still up to date.")
+    if cache_settings.write_cache:
+        cache_settings.get_response_cache().mark_revalidated(endpoint, params)
+
+    return stale_response.data, stale_response.status
+
+def check_response_status(r):
+    if r.status_code != 200:
+        if r.status_code >= 400 and r.status_code < 500:
+            raise RuntimeError(f"API returned {r.status_code}: {r.reason}")
+
+        raise ConnectionError(f"Got status code {r.status_code}!")
+
 def get_in_loop_code(endpoint, params, cache_settings):
     if params is None:
         params = {}
@@ -45,69 +297,179 @@ def get_in_loop_code(endpoint, params, cache_settings):
     if cache_settings is None:
         cache_settings = default_cache_settings
 
-    endpoint_as_path = get_cached_endpoint_filepath(endpoint, params, cache_settings)
-    if cache_settings.read_cache and endpoint_as_path.is_file():
-        error_code = None
-
-        endpoint_as_path_size = endpoint_as_path.stat().st_size
-        if endpoint_as_path_size == 0:
-            return {}, 404
-
-        #print(f"endpoint_as_path: {endpoint_as_path}")
-        with open(endpoint_as_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        if error_code is None:
-            return data, 200
+    fresh_response, stale_response = get_fresh_cached_response(endpoint, params, cache_settings)
+    if fresh_response is not None:
+        return fresh_response
 
     url = f"{API_URL}{endpoint}"
     print(f"url: {url}?{urllib.parse.urlencode(params, doseq=True)}")
     start_time = time.time()
-    r = requests.get(url, params=params)
+    r = requests.get(url, params=params, headers=stale_response.get_revalidation_headers() if stale_response is not None else None)
     end_time = time.time()
     print(f"Request took {end_time - start_time}.")
 
-    if cache_settings.write_cache:
-        endpoint_as_path.parent.mkdir(parents=True, exist_ok=True)
+    revalidated_response = get_revalidated_response(endpoint, params, cache_settings, r, stale_response)
+    if revalidated_response is not None:
+        return revalidated_response
 
-    if r.status_code != 200:
-        if r.status_code >= 400 and r.status_code < 500:
-            raise RuntimeError(f"API returned {r.status_code}: {r.reason}")
+    check_response_status(r)
+    data = r.json()
+    write_cached_response(endpoint, params, data, cache_settings, r.headers)
 
-        raise ConnectionError(f"Got status code {r.status_code}!")
-        #return r.reason, r.status_code
-        #if r.status_code != 404:
-        #    raise ConnectionError(f"Got status code {r.status_code}!")
-        #
-        #if cache_settings.write_cache:
-        #    if r.status_code == 404:
-        #        endpoint_as_path.touch()
-        #    else:
-        #        print(f"Got non-404 error code: {r.status_code}")
-        #        with open(endpoint_as_path, "w+") as f:
-        #            f.write(str(r.status_code))
-        #
-        #return r.reason, r.status_code
+    if cache_settings.rate_limit:
+        time.sleep(1)
 
-    data = r.json()
+    return data, r.status_code
+
+# speedrun.com allows 100 requests per minute, stay a bit under that
+DEFAULT_REQUESTS_PER_SECOND = 1.5
+DEFAULT_REQUEST_BURST = 5
+DEFAULT_PAGES_IN_FLIGHT = 4
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "last_refill_time", "lock")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill_time = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                cur_time = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (cur_time - self.last_refill_time) * self.rate)
+                self.last_refill_time = cur_time
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# A request which is already running, shared by every caller asking for the same URL
+class InFlightRequest:
+    __slots__ = ("task", "num_waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.num_waiters = 0
+
+# asyncio counterpart of `get`. Requests go through one keep-alive requests.Session
+# (run in a worker thread so the event loop stays free) and are paced by a token bucket
+# instead of sleeping after every call. Cache semantics are the same as `get`.
+class SrcomClient:
+    __slots__ = ("cache_settings", "session", "rate_limiter", "pages_in_flight", "requests_in_flight")
+
+    def __init__(self, cache_settings=None, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_REQUEST_BURST, pages_in_flight=DEFAULT_PAGES_IN_FLIGHT):
+        if cache_settings is None:
+            cache_settings = default_cache_settings
+
+        self.cache_settings = cache_settings
+        self.pages_in_flight = max(1, pages_in_flight)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        if cache_settings.rate_limit:
+            self.rate_limiter = TokenBucket(requests_per_second, burst)
+        else:
+            self.rate_limiter = None
+        self.requests_in_flight = {}
+
+    # Identical requests made while one is already in flight (e.g. by several targets scraped at the same time)
+    # share its response. The request is only cancelled once every caller waiting for it was cancelled.
+    async def get(self, endpoint, params=None, require_success=False):
+        request_key = (endpoint, urllib.parse.urlencode(params, doseq=True) if params else "")
+        in_flight_request = self.requests_in_flight.get(request_key)
+        if in_flight_request is None:
+            in_flight_request = InFlightRequest(asyncio.ensure_future(self.get_with_retries(endpoint, params)))
+            self.requests_in_flight[request_key] = in_flight_request
+
+            def forget_request(task):
+                if self.requests_in_flight.get(request_key) is in_flight_request:
+                    del self.requests_in_flight[request_key]
+
+            in_flight_request.task.add_done_callback(forget_request)
+
+        in_flight_request.num_waiters += 1
+        try:
+            return await asyncio.shield(in_flight_request.task)
+        finally:
+            in_flight_request.num_waiters -= 1
+            if in_flight_request.num_waiters == 0 and not in_flight_request.task.done():
+                in_flight_request.task.cancel()
+
+    async def get_with_retries(self, endpoint, params=None):
+        exception_sleep_time = 15
 
-    if cache_settings.write_cache:
-        endpoint_as_path.parent.mkdir(parents=True, exist_ok=True)
-        data_as_str = json.dumps(data, separators=(",", ":"))
-        exit_after_write = False
         while True:
             try:
-                with open(endpoint_as_path, "w+", encoding="utf-8") as f:
-                    f.write(data_as_str)
-                break
-            except KeyboardInterrupt:
-                print("Saving speedrun.com API cache, please stop Ctrl-C'ing")
-                exit_after_write = True
+                return (await self.get_in_loop_code(endpoint, params))[0]
+            except ConnectionError as e:
+                print(f"Exception occurred: {e}\n{''.join(traceback.format_tb(e.__traceback__))}\nSleeping for {exception_sleep_time} seconds now.")
+                await asyncio.sleep(exception_sleep_time)
+                exception_sleep_time *= 2
+                if exception_sleep_time > 1000:
+                    exception_sleep_time = 1000
 
-        if exit_after_write:
-            sys.exit(1)
+    async def get_in_loop_code(self, endpoint, params):
+        if params is None:
+            params = {}
 
-    if cache_settings.rate_limit:
-        time.sleep(1)
+        fresh_response, stale_response = get_fresh_cached_response(endpoint, params, self.cache_settings)
+        if fresh_response is not None:
+            return fresh_response
 
-    return data, r.status_code
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire()
+
+        url = f"{API_URL}{endpoint}"
+        print(f"url: {url}?{urllib.parse.urlencode(params, doseq=True)}")
+        start_time = time.time()
+        r = await asyncio.to_thread(self.session.get, url, params=params, headers=stale_response.get_revalidation_headers() if stale_response is not None else None)
+        end_time = time.time()
+        print(f"Request took {end_time - start_time}.")
+
+        revalidated_response = get_revalidated_response(endpoint, params, self.cache_settings, r, stale_response)
+        if revalidated_response is not None:
+            return revalidated_response
+
+        check_response_status(r)
+        data = r.json()
+        write_cached_response(endpoint, params, data, self.cache_settings, r.headers)
+
+        return data, r.status_code
+
+    # Pipelined pagination over `endpoint_format`, which must contain an `{offset}` placeholder.
+    # Offsets are predictable, so up to `pages_in_flight` pages are requested ahead of the one
+    # being consumed (the token bucket still decides when they actually go out).
+    # Pages are yielded in order as (offset, data), stopping after the first short page
+    # or once `max_offset` is reached. Requests still in flight are cancelled when the
+    # consumer stops early, so wrap the iteration in contextlib.aclosing.
+    async def get_pages(self, endpoint_format, page_size, max_offset=None, start_offset=0):
+        pending = collections.deque()
+        next_offset = start_offset
+
+        try:
+            while True:
+                while len(pending) < self.pages_in_flight and (max_offset is None or next_offset < max_offset):
+                    endpoint = endpoint_format.format(offset=next_offset)
+                    pending.append((next_offset, asyncio.ensure_future(self.get(endpoint))))
+                    next_offset += page_size
+
+                if len(pending) == 0:
+                    return
+
+                offset, page_task = pending.popleft()
+                data = await page_task
+                yield offset, data
+
+                if data["pagination"]["size"] < page_size:
+                    return
+        finally:
+            for offset, page_task in pending:
+                page_task.cancel()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,31 @@
+# Times the format selection of QualityFormatSelector against the reference selection it replaced,
+# on every format list of the fixtures. (QualityPostprocessor.run is left out, since yt-dlp wraps it in
+# more work than the selection itself.) Run with `python tests/bench_quality_selection.py [number of runs]`
+import sys
+import timeit
+
+import test_quality_selection
+from test_quality_selection import speedrunrescue, quality_selection_reference
+
+DEFAULT_NUM_RUNS = 20000
+
+def main():
+    num_runs = int(sys.argv[1]) if len(sys.argv) >= 2 else DEFAULT_NUM_RUNS
+    fixtures = test_quality_selection.load_formats_fixtures()
+    desired_quality = speedrunrescue.DesiredQuality.from_string("720")
+    format_selector = speedrunrescue.QualityFormatSelector(desired_quality)
+
+    print(f"{'fixture':<24} {'formats':>7} {'reference':>12} {'selector':>12} {'speedup':>8}")
+    total_reference_time = 0
+    total_selector_time = 0
+    for name, formats in fixtures.items():
+        reference_time = timeit.timeit(lambda: quality_selection_reference.select_formats(desired_quality, formats), number=num_runs) / num_runs
+        selector_time = timeit.timeit(lambda: format_selector.select_formats(formats), number=num_runs) / num_runs
+        total_reference_time += reference_time
+        total_selector_time += selector_time
+        print(f"{name:<24} {len(formats):>7} {reference_time * 1e6:>10.2f}us {selector_time * 1e6:>10.2f}us {reference_time / selector_time:>7.2f}x")
+
+    print(f"{'total':<24} {'':>7} {total_reference_time * 1e6:>10.2f}us {total_selector_time * 1e6:>10.2f}us {total_reference_time / total_selector_time:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
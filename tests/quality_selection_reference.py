@@ -0,0 +1,60 @@
+# The format selection of QualityPostprocessor before it was moved into QualityFormatSelector,
+# kept as the reference which the selector has to agree with
+
+def is_format_source(quality_format):
+    # No hard and fast rule, so test multiple things
+    if "source" in quality_format["format_id"].lower() or "source" in quality_format.get("format_note", "").lower() or "source" in quality_format.get("format", "").lower():
+        return True
+    else:
+        return False
+
+def select_formats(desired_quality, formats):
+    desired_height = desired_quality.desired_height
+    fallback_should_increase_quality = desired_quality.fallback_should_increase_quality
+    best_height = 0
+    best_tbr = 0
+    best_format_id = None
+    source_format = None
+
+    formats_sorted_by_height = sorted(formats, key=lambda x: x.get("height", 0))
+
+    for quality_format in formats_sorted_by_height:
+        if quality_format["vcodec"] == "none":
+            continue
+
+        format_id = quality_format["format_id"]
+        height = quality_format.get("height")
+        if height is None:
+            continue
+
+        tbr = quality_format["tbr"]
+        is_source = is_format_source(quality_format)
+
+        if is_source:
+            source_format = quality_format
+
+        if best_height == 0 or height < desired_height:
+            best_height = height
+            best_tbr = tbr
+            best_format_id = format_id
+        elif height == desired_height:
+            if best_height != desired_height or is_source:
+                best_height = height
+                best_tbr = tbr
+                best_format_id = format_id
+        elif fallback_should_increase_quality:
+            if best_height < desired_height or (best_height == height and is_source):
+                best_height = height
+                best_tbr = tbr
+                best_format_id = format_id
+
+    if source_format is not None and source_format.get("tbr") is not None and best_tbr is not None and source_format["tbr"] < best_tbr:
+        best_format_id = source_format["format_id"]
+
+    new_formats = [quality_format for quality_format in formats if quality_format["format_id"] == best_format_id or (quality_format["acodec"] != "none" and quality_format["vcodec"] == "none")]
+
+    # if we somehow can't find any formats, then just try to download anything
+    if len(new_formats) != 0:
+        return new_formats
+    else:
+        return formats
@@ -0,0 +1,84 @@
+import json
+import pathlib
+import random
+import sys
+import unittest
+
+TESTS_PATH = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(TESTS_PATH.parent))
+sys.path.insert(0, str(TESTS_PATH))
+
+import speedrunrescue
+import quality_selection_reference
+
+FORMATS_FIXTURES_FILENAME = TESTS_PATH / "fixtures" / "twitch_formats.json"
+VIDEO_QUALITIES = ("160p", "360", "<=480", "480p", ">=480", "720", "<=720", "720p", "900", "<=900", "1080p", ">=1080", "1440", "<=1440", "2160", "<=144", "0")
+
+def load_formats_fixtures():
+    with open(FORMATS_FIXTURES_FILENAME, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def select_format_ids(desired_quality, formats):
+    info = {"formats": list(formats)}
+    speedrunrescue.QualityPostprocessor(desired_quality).run(info)
+    return [quality_format["format_id"] for quality_format in info["formats"]]
+
+def select_reference_format_ids(desired_quality, formats):
+    return [quality_format["format_id"] for quality_format in quality_selection_reference.select_formats(desired_quality, list(formats))]
+
+# Shuffles the formats of a fixture and drops some of them, so that duplicate heights,
+# missing sources and unusual orders show up in every combination
+def create_variant(formats, rng):
+    variant = rng.sample(formats, rng.randint(0, len(formats)))
+    for i, quality_format in enumerate(variant):
+        if rng.random() < 0.1:
+            variant[i] = dict(quality_format, tbr=rng.choice((None, float(rng.randint(100, 9000)))))
+
+    return variant
+
+class QualitySelectionTest(unittest.TestCase):
+    def test_fixtures_match_reference(self):
+        for name, formats in load_formats_fixtures().items():
+            for video_quality in VIDEO_QUALITIES:
+                desired_quality = speedrunrescue.DesiredQuality.from_string(video_quality)
+                with self.subTest(fixture=name, video_quality=video_quality):
+                    self.assertEqual(select_format_ids(desired_quality, formats), select_reference_format_ids(desired_quality, formats))
+
+    def test_variants_match_reference(self):
+        rng = random.Random(19)
+        fixtures = list(load_formats_fixtures().items())
+        desired_qualities = [speedrunrescue.DesiredQuality.from_string(video_quality) for video_quality in VIDEO_QUALITIES]
+        for _ in range(2000):
+            name, formats = rng.choice(fixtures)
+            variant = create_variant(formats, rng)
+            for video_quality, desired_quality in zip(VIDEO_QUALITIES, desired_qualities):
+                with self.subTest(fixture=name, video_quality=video_quality, formats=[quality_format["format_id"] for quality_format in variant]):
+                    self.assertEqual(select_format_ids(desired_quality, variant), select_reference_format_ids(desired_quality, variant))
+
+    def test_picks_expected_formats(self):
+        fixtures = load_formats_fixtures()
+        expected = (
+            ("vod_1080p60", "720", ["audio_only", "720p30"]),
+            ("vod_1080p60", "1080p", ["audio_only", "1080p60"]),
+            ("vod_720p60_source", "720", ["audio_only", "720p60"]),
+            ("vod_low_bitrate_source", "720", ["audio_only", "1080p60"]),
+            ("vod_source_only", "480", ["audio_only", "900p60"]),
+            ("vod_legacy_named", "720", ["audio_only", "Source"]),
+            ("vod_missing_heights", "1080", ["audio_only", "High"]),
+            ("highlight_1440p60", "<=900", ["audio_only", "720p60"]),
+        )
+        for name, video_quality, format_ids in expected:
+            with self.subTest(fixture=name, video_quality=video_quality):
+                self.assertEqual(select_format_ids(speedrunrescue.DesiredQuality.from_string(video_quality), fixtures[name]), format_ids)
+
+    def test_tolerates_none_fields(self):
+        # the reference selection failed on these
+        formats = [
+            {"format_id": "audio_only", "tbr": 160.0, "vcodec": "none", "acodec": "mp4a.40.2", "format_note": None},
+            {"format_id": "720p60", "tbr": 3412.0, "height": 720, "vcodec": "avc1.64002A", "acodec": "mp4a.40.2", "format_note": None, "format": None},
+            {"format_id": "1080p60", "tbr": 6000.0, "height": None, "vcodec": "avc1.64002A", "acodec": "mp4a.40.2"},
+        ]
+        self.assertEqual(select_format_ids(speedrunrescue.DesiredQuality.from_string("1080"), formats), ["audio_only", "720p60"])
+
+if __name__ == "__main__":
+    unittest.main()
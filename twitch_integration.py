@@ -1,15 +1,107 @@
 from twitchAPI.twitch import Twitch
 from twitchAPI.helper import first
+from twitchAPI.type import VideoType, TwitchResourceNotFound
 import asyncio
+import contextlib
 import json
 import pathlib
 import itertools
 import re
 import sys
+import os
+import time
+import datetime
+import sqlite3
+import collections.abc
+import srcomapi
 
 twitch_c_v_url_regex = re.compile(r"(?:https?:\/\/)?(?:\w+\.)?twitch\.tv\/(\w+)\/([cv])\/(\d+)", re.IGNORECASE)
 twitch_current_url_regex = re.compile(r"(?:https?:\/\/)?(?:\w+\.)?twitch\.tv\/videos/(\d+)", re.IGNORECASE)
 
+# Twitch allows 800 requests per minute for an app access token
+TWITCH_REQUESTS_PER_SECOND = 800 / 60
+DEFAULT_TWITCH_CONCURRENCY = 8
+SAVE_CACHE_EVERY_NUM_USERS = 50
+
+# Wraps a paginated twitchAPI generator so that every page fetch takes a token from `rate_limiter`.
+# twitchAPI itself only waits out the rate limit (Ratelimit-Reset) for the request that hit it,
+# so this keeps concurrent fetches from running into it in the first place.
+async def rate_limited_pages(generator, page_size, rate_limiter):
+    num_items = 0
+    try:
+        while True:
+            if num_items % page_size == 0:
+                await rate_limiter.acquire()
+
+            try:
+                item = await generator.__anext__()
+            except StopAsyncIteration:
+                break
+
+            num_items += 1
+            yield item
+    finally:
+        await generator.aclose()
+
+# Twitch limits the total duration of highlights of a channel to 100 hours
+HIGHLIGHT_LIMIT_SECONDS = 360000
+
+# Adds up the durations of a user's highlights, newest first, and stops once they reach the highlight limit,
+# since whether the channel is over the limit is all that matters.
+# Returns the durations of the scanned highlights by video id, their total, and whether every highlight was scanned.
+async def scan_highlights(twitch, user_id, rate_limiter):
+    highlights = {}
+    highlight_duration = 0
+    highlights_complete = True
+
+    async with contextlib.aclosing(rate_limited_pages(twitch.get_videos(user_id=user_id, first=100, video_type=VideoType.HIGHLIGHT), 100, rate_limiter)) as user_videos:
+        async for user_video in user_videos:
+            duration = parse_duration(user_video.duration)
+            highlights[user_video.id] = duration
+            highlight_duration += duration
+            if highlight_duration >= HIGHLIGHT_LIMIT_SECONDS:
+                highlights_complete = False
+                break
+
+    return highlights, highlight_duration, highlights_complete
+
+# Brings a previous highlight scan up to date: highlights which were deleted since are dropped,
+# and highlights newer than the newest known one are added.
+# If the total falls under the limit while the previous scan had stopped early, there may be older
+# highlights which were never looked at, so the user gets scanned again in full instead.
+async def refresh_highlights(twitch, user_id, user_info, rate_limiter):
+    known_highlights = user_info.get("highlights") or {}
+    highlights = {}
+    for known_highlight_ids_chunk in grouper(known_highlights.keys(), 100):
+        try:
+            async for user_video in rate_limited_pages(twitch.get_videos(ids=known_highlight_ids_chunk, first=100), 100, rate_limiter):
+                highlights[user_video.id] = known_highlights[user_video.id]
+        except TwitchResourceNotFound:
+            # Twitch answers with a 404 if none of the videos exist anymore
+            pass
+
+    highlight_duration = sum(highlights.values())
+    highlights_complete = user_info.get("highlights_complete", True)
+
+    new_highlights = {}
+    async with contextlib.aclosing(rate_limited_pages(twitch.get_videos(user_id=user_id, first=100, video_type=VideoType.HIGHLIGHT), 100, rate_limiter)) as user_videos:
+        async for user_video in user_videos:
+            if user_video.id in known_highlights:
+                break
+
+            duration = parse_duration(user_video.duration)
+            new_highlights[user_video.id] = duration
+            highlight_duration += duration
+            if highlight_duration >= HIGHLIGHT_LIMIT_SECONDS:
+                highlights_complete = False
+                break
+
+    if highlight_duration < HIGHLIGHT_LIMIT_SECONDS and not highlights_complete:
+        return await scan_highlights(twitch, user_id, rate_limiter)
+
+    highlights.update(new_highlights)
+    return highlights, highlight_duration, highlights_complete
+
 def grouper(iterable, n):
     it = iter(iterable)
     while True:
@@ -27,7 +119,7 @@ def parse_duration(duration):
         minutes = match_obj.group(2)
         seconds = match_obj.group(3)
         if hours is None and minutes is None and seconds is None:
-            raise RuntimeError(f"Invalid duration \"{expiry_time}\" provided for expiry time!")
+            raise RuntimeError(f"Invalid duration \"{duration}\" provided!")
 
         if hours is None:
             hours = 0
@@ -41,27 +133,210 @@ def parse_duration(duration):
         except ValueError:
             raise RuntimeError(f"At least one of hours, seconds, and minutes not an integer!")
     else:
-        raise RuntimeError(f"Invalid duration \"{expiry_time}\" provided for expiry time!")
+        raise RuntimeError(f"Invalid duration \"{duration}\" provided!")
 
     return duration_as_seconds
 
-class UserCache:
-    __slots__ = ("cache_filename", "cache_info")
+def create_empty_cache_info():
+    return {
+        "video_infos": {},
+        "user_infos": {},
+        "total_duration": -1
+    }
+
+# The whole cache as one json file, rewritten in full on every save.
+class JsonCacheStore:
+    __slots__ = ("cache_filename",)
 
     def __init__(self, cache_filename):
-        cache_filepath = pathlib.Path(cache_filename)
+        self.cache_filename = cache_filename
+
+    def load(self):
+        cache_filepath = pathlib.Path(self.cache_filename)
         if cache_filepath.is_file():
-            with open(cache_filename, "r") as f:
-                cache_info = json.load(f)
+            with open(self.cache_filename, "r") as f:
+                return json.load(f)
         else:
-            cache_info = {
-                "video_infos": {},
-                "user_infos": {},
-                "total_duration": -1
-            }
+            return create_empty_cache_info()
+
+    def mark_dirty(self, table_name, key):
+        pass
+
+    def save(self, cache_info):
+        cache_info_as_str = json.dumps(cache_info, indent=2)
+        # write to a temporary file first so that a crash mid-write can't leave a truncated cache
+        temp_cache_filename = f"{self.cache_filename}.tmp"
+        with open(temp_cache_filename, "w+") as f:
+            f.write(cache_info_as_str)
+
+        os.replace(temp_cache_filename, self.cache_filename)
+
+    def close(self):
+        pass
+
+# Dict-like view of a key/json value table, loading rows only when they are accessed.
+# Changed entries are tracked so that only they get written back on flush.
+# Values are plain dicts, so changes made inside them must be reported with mark_dirty.
+class SqliteTable(collections.abc.MutableMapping):
+    __slots__ = ("connection", "table_name", "loaded", "dirty", "deleted", "streamed_item")
+
+    def __init__(self, connection, table_name):
+        self.connection = connection
+        self.table_name = table_name
+        self.loaded = {}
+        self.dirty = set()
+        self.deleted = set()
+        # the row which items() is at, which is only kept if it's marked dirty
+        self.streamed_item = None
+        with connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table_name} (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def __getitem__(self, key):
+        value = self.loaded.get(key)
+        if value is not None:
+            return value
+
+        if key in self.deleted:
+            raise KeyError(key)
+
+        row = self.connection.execute(f"SELECT value FROM {self.table_name} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+
+        value = json.loads(row[0])
+        self.loaded[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+        self.dirty.add(key)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        self[key]
+        del self.loaded[key]
+        self.dirty.discard(key)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.loaded:
+            return True
+        if key in self.deleted:
+            return False
 
-        self.cache_info = cache_info
-        self.cache_filename = cache_filename
+        return self.connection.execute(f"SELECT 1 FROM {self.table_name} WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        for key, value in self.items():
+            yield key
+
+    def __len__(self):
+        stored_keys = {row[0] for row in self.connection.execute(f"SELECT key FROM {self.table_name}")}
+        return len((stored_keys | self.loaded.keys()) - self.deleted)
+
+    # Streams rows from the database instead of looking each key up separately. The rows which weren't
+    # loaded before aren't kept, so that walking the table doesn't load all of it into memory.
+    def items(self):
+        loaded_items = list(self.loaded.items())
+        yield from loaded_items
+
+        cursor = self.connection.execute(f"SELECT key, value FROM {self.table_name}")
+        try:
+            for key, value_as_str in cursor:
+                if key in self.loaded or key in self.deleted:
+                    continue
+
+                value = json.loads(value_as_str)
+                self.streamed_item = (key, value)
+                yield key, value
+        finally:
+            self.streamed_item = None
+
+    def values(self):
+        for key, value in self.items():
+            yield value
+
+    def mark_dirty(self, key):
+        if key not in self.loaded and self.streamed_item is not None and self.streamed_item[0] == key:
+            # changed while walking the table, so it has to be kept until it's written
+            self.loaded[key] = self.streamed_item[1]
+        self.dirty.add(key)
+
+    # must be called inside a transaction
+    def flush(self):
+        self.connection.executemany(f"INSERT OR REPLACE INTO {self.table_name} (key, value) VALUES (?, ?)", ((key, json.dumps(self.loaded[key], separators=(",", ":"))) for key in self.dirty))
+        self.connection.executemany(f"DELETE FROM {self.table_name} WHERE key = ?", ((key,) for key in self.deleted))
+        self.dirty.clear()
+        self.deleted.clear()
+
+# The cache in a sqlite database. Entries are loaded when first used, and saving only writes
+# the entries which changed since the last save, in a single transaction.
+# If the database doesn't exist yet but a json cache does, the json cache is imported.
+class SqliteCacheStore:
+    __slots__ = ("connection", "tables", "json_cache_filename")
+
+    def __init__(self, cache_filename, json_cache_filename=None):
+        is_new = not pathlib.Path(cache_filename).is_file()
+        self.connection = sqlite3.connect(cache_filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.tables = {
+            "video_infos": SqliteTable(self.connection, "video_infos"),
+            "user_infos": SqliteTable(self.connection, "user_infos")
+        }
+        if is_new and json_cache_filename is not None and pathlib.Path(json_cache_filename).is_file():
+            print(f"Importing Twitch cache from {json_cache_filename}!")
+            json_cache_info = JsonCacheStore(json_cache_filename).load()
+            for table_name, table in self.tables.items():
+                for key, value in json_cache_info[table_name].items():
+                    table[key] = value
+
+            self.save(None)
+
+    def load(self):
+        return {
+            "video_infos": self.tables["video_infos"],
+            "user_infos": self.tables["user_infos"],
+            "total_duration": -1
+        }
+
+    def mark_dirty(self, table_name, key):
+        self.tables[table_name].mark_dirty(key)
+
+    def save(self, cache_info):
+        with self.connection:
+            for table in self.tables.values():
+                table.flush()
+
+    def close(self):
+        self.connection.close()
+
+def create_cache_store(cache_filename, cache_backend):
+    if cache_backend == "json":
+        return JsonCacheStore(cache_filename)
+    elif cache_backend == "sqlite":
+        cache_filepath = pathlib.Path(cache_filename)
+        if cache_filepath.suffix == ".json":
+            return SqliteCacheStore(str(cache_filepath.with_suffix(".sqlite3")), cache_filename)
+        else:
+            return SqliteCacheStore(cache_filename)
+    else:
+        raise RuntimeError(f"Unknown Twitch cache backend \"{cache_backend}\" (must be `json` or `sqlite`)")
+
+class UserCache:
+    __slots__ = ("cache_store", "cache_info", "video_fetches_in_flight", "user_scans_in_flight", "scan_semaphore", "scan_rate_limiter", "changed_usernames")
+
+    def __init__(self, cache_store):
+        self.cache_store = cache_store
+        self.cache_info = cache_store.load()
+        # when several targets are processed at the same time, videos and users which are
+        # already being fetched for one target are waited for instead of being fetched again
+        self.video_fetches_in_flight = {}
+        self.user_scans_in_flight = {}
+        # shared by all scans, so that scanning for several targets at once stays within the limits
+        self.scan_semaphore = None
+        self.scan_rate_limiter = None
+        # the users whose highlight info changed since their total duration was last determined
+        self.changed_usernames = set()
 
     def parse_valid_video_id(self, video_url, update_c=False):
         match_obj = twitch_c_v_url_regex.match(video_url)
@@ -69,8 +344,10 @@ class UserCache:
             url_type = match_obj.group(2)
             if url_type == "c":
                 if update_c:
-                    user_info = self.get_user_info(match_obj.group(1))
+                    username = match_obj.group(1)
+                    user_info = self.get_user_info(username)
                     user_info["c_video_urls"].append(video_url)
+                    self.cache_store.mark_dirty("user_infos", username)
                     print(f"Skipped c-type url {video_url}")
                 video_id = None
             else:
@@ -85,63 +362,171 @@ class UserCache:
 
         return video_id
 
-    async def update_video_infos_from_video_urls(self, twitch, video_urls):
+    # Returns the ids of the valid video urls
+    async def update_video_infos_from_video_urls(self, twitch, video_urls, save=True):
+        video_ids = []
         valid_nonfound_video_ids = []
+        other_video_fetches = set()
         print("Finding valid video ids!")
         for video_url in video_urls:
             video_id = self.parse_valid_video_id(video_url, update_c=True)
             if video_id is not None:
+                video_ids.append(video_id)
                 video_info = self.cache_info["video_infos"].get(video_id)
                 if video_info is None:
-                    valid_nonfound_video_ids.append(video_id)
+                    video_fetch = self.video_fetches_in_flight.get(video_id)
+                    if video_fetch is not None:
+                        other_video_fetches.add(video_fetch)
+                    else:
+                        valid_nonfound_video_ids.append(video_id)
 
         if len(valid_nonfound_video_ids) != 0:
-            print(f"Fetching video info from {len(valid_nonfound_video_ids)} valid video ids!")
-            for i, valid_nonfound_video_ids_chunk in enumerate(grouper(valid_nonfound_video_ids, 100)):
-                print(f"video_ids_chunk: {valid_nonfound_video_ids_chunk}")
-                print(f"Parsing chunk {100*i}")
-                async for video_info_obj in twitch.get_videos(ids=valid_nonfound_video_ids_chunk, first=100):
-                    video_info = video_info_obj.to_dict()
-                    self.cache_info["video_infos"][video_info["id"]] = video_info
-            
-            valid_nonfound_video_ids_as_set = frozenset(valid_nonfound_video_ids)
-            found_video_info_ids = frozenset(self.cache_info["video_infos"].keys())
-            missing_video_ids = valid_nonfound_video_ids_as_set - found_video_info_ids
-
-            for missing_video_id in missing_video_ids:
-                self.cache_info["video_infos"][missing_video_id] = {"missing": True}
-
-        self.save_cache()
+            video_fetch = asyncio.get_running_loop().create_future()
+            for video_id in valid_nonfound_video_ids:
+                self.video_fetches_in_flight[video_id] = video_fetch
 
-    async def update_user_infos_from_video_infos(self, twitch):
-        for video_id, video_info in self.cache_info["video_infos"].items():
-            if video_info.get("missing"):
+            try:
+                await self.fetch_video_infos(twitch, valid_nonfound_video_ids)
+            finally:
+                for video_id in valid_nonfound_video_ids:
+                    self.video_fetches_in_flight.pop(video_id, None)
+                video_fetch.set_result(None)
+
+        if len(other_video_fetches) != 0:
+            await asyncio.gather(*other_video_fetches)
+
+        if save:
+            self.save_cache()
+
+        return video_ids
+
+    async def fetch_video_infos(self, twitch, valid_nonfound_video_ids):
+        print(f"Fetching video info from {len(valid_nonfound_video_ids)} valid video ids!")
+        for i, valid_nonfound_video_ids_chunk in enumerate(grouper(valid_nonfound_video_ids, 100)):
+            print(f"video_ids_chunk: {valid_nonfound_video_ids_chunk}")
+            print(f"Parsing chunk {100*i}")
+            async for video_info_obj in twitch.get_videos(ids=valid_nonfound_video_ids_chunk, first=100):
+                video_info = video_info_obj.to_dict()
+                self.cache_info["video_infos"][video_info["id"]] = video_info
+        
+        missing_video_ids = [video_id for video_id in valid_nonfound_video_ids if video_id not in self.cache_info["video_infos"]]
+
+        for missing_video_id in missing_video_ids:
+            self.cache_info["video_infos"][missing_video_id] = {"missing": True}
+
+    # Only the users of `video_ids` are updated if given, otherwise the users of all videos of the cache
+    async def update_user_infos_from_video_infos(self, twitch, max_concurrency=DEFAULT_TWITCH_CONCURRENCY, max_age=None, video_ids=None, save=True):
+        user_ids_to_fetch = {}
+        user_ids_to_refresh = {}
+        if max_age is not None:
+            stale_before = time.time() - max_age
+        if video_ids is None:
+            video_infos = self.cache_info["video_infos"].values()
+        else:
+            video_infos = (self.cache_info["video_infos"].get(video_id) for video_id in video_ids)
+        for video_info in video_infos:
+            if video_info is None or video_info.get("missing"):
                 continue
 
             username = video_info["user_login"]
             user_info = self.get_user_info(username)
-            if len(user_info["videos"]) == 0:
-                print(f"Downloading video info for {username}!")
-                user_id = video_info["user_id"]
-                num_video_infos = 0
-                async for user_video_info_obj in twitch.get_videos(user_id=user_id, first=100):
-                    user_video_info = user_video_info_obj.to_dict()
-                    user_info["videos"][user_video_info["id"]] = user_video_info
-                    num_video_infos += 1
-                
-                print(f"num_video_infos: {num_video_infos}")
+            if not self.has_highlight_info(username, user_info):
+                user_ids_to_fetch[username] = video_info["user_id"]
+            elif max_age is not None and user_info.get("fetched_at", 0) < stale_before:
+                user_ids_to_refresh[username] = video_info["user_id"]
+
+        num_users_to_update = len(user_ids_to_fetch) + len(user_ids_to_refresh)
+        if num_users_to_update == 0:
+            return
+
+        print(f"Downloading highlight info for {len(user_ids_to_fetch)} users, refreshing {len(user_ids_to_refresh)} users!")
+        if self.scan_semaphore is None:
+            self.scan_semaphore = asyncio.Semaphore(max_concurrency)
+            self.scan_rate_limiter = srcomapi.TokenBucket(TWITCH_REQUESTS_PER_SECOND, max_concurrency)
+        semaphore = self.scan_semaphore
+        rate_limiter = self.scan_rate_limiter
+        num_users_done = 0
+
+        async def update_user_info(username, user_id, refresh):
+            nonlocal num_users_done
+            async with semaphore:
+                user_info = self.get_user_info(username)
+                fetched_at = time.time()
+                if refresh:
+                    print(f"Refreshing highlight info for {username}!")
+                    highlights, highlight_duration, highlights_complete = await refresh_highlights(twitch, user_id, user_info, rate_limiter)
+                else:
+                    print(f"Downloading highlight info for {username}!")
+                    highlights, highlight_duration, highlights_complete = await scan_highlights(twitch, user_id, rate_limiter)
+
+                # only store finished scans, so that an interrupted scan gets redone next time
+                user_info["highlights"] = highlights
+                user_info["highlight_duration"] = highlight_duration
+                user_info["highlights_complete"] = highlights_complete
+                user_info["fetched_at"] = fetched_at
+                self.cache_store.mark_dirty("user_infos", username)
+                self.changed_usernames.add(username)
+                print(f"Highlight duration for {username}: {highlight_duration}{'' if highlights_complete else ' (stopped scanning at the limit)'}")
+                num_users_done += 1
+                if num_users_done % SAVE_CACHE_EVERY_NUM_USERS == 0:
+                    print(f"Fetched {num_users_done}/{num_users_to_update} users")
+                    self.save_cache()
+
+        async def update_user_info_once(username, user_id, refresh):
+            user_scan = self.user_scans_in_flight.get(username)
+            if user_scan is None:
+                user_scan = asyncio.ensure_future(update_user_info(username, user_id, refresh))
+                self.user_scans_in_flight[username] = user_scan
+                user_scan.add_done_callback(lambda task: self.user_scans_in_flight.pop(username, None))
+
+            await user_scan
+
+        try:
+            await asyncio.gather(
+                *(update_user_info_once(username, user_id, False) for username, user_id in user_ids_to_fetch.items()),
+                *(update_user_info_once(username, user_id, True) for username, user_id in user_ids_to_refresh.items())
+            )
+        finally:
+            if save:
                 self.save_cache()
 
+    def has_highlight_info(self, username, user_info):
+        if "highlight_duration" in user_info:
+            return True
+
+        # caches from before highlight scans stored every video of the user
+        videos = user_info.get("videos")
+        if videos:
+            highlights = {video_id: parse_duration(user_video_info["duration"]) for video_id, user_video_info in videos.items() if user_video_info["type"] == "highlight"}
+            user_info["highlights"] = highlights
+            user_info["highlight_duration"] = sum(highlights.values())
+            user_info["highlights_complete"] = True
+            del user_info["videos"]
+            self.cache_store.mark_dirty("user_infos", username)
+            self.changed_usernames.add(username)
+            return True
+
+        return False
+
+    # Only the users whose highlight info changed are looked at, the others are still up to date
     def determine_at_risk_users(self):
         print(f"Determining at risk users!")
-        for username, user_info in self.cache_info["user_infos"].items():
-            total_duration = 0
-            for video_id, user_video_info in user_info["videos"].items():
-                if user_video_info["type"] == "highlight":
-                    total_duration += parse_duration(user_video_info["duration"])
+        user_infos = self.cache_info["user_infos"]
+        for username in list(self.changed_usernames):
+            user_info = user_infos.get(username)
+            if user_info is None:
+                continue
 
-            user_info["total_duration"] = total_duration
+            if self.has_highlight_info(username, user_info):
+                total_duration = user_info["highlight_duration"]
+            else:
+                total_duration = 0
 
+            if user_info.get("total_duration") != total_duration:
+                user_info["total_duration"] = total_duration
+                self.cache_store.mark_dirty("user_infos", username)
+
+        self.changed_usernames.clear()
         self.save_cache()
 
     def is_video_at_risk(self, video_url):
@@ -160,14 +545,36 @@ class UserCache:
             # Be safe and download the video if for some reason the username doesn't exist
             return True
 
-        if user_info["total_duration"] >= 360000:
+        if user_info.get("total_duration", 0) >= HIGHLIGHT_LIMIT_SECONDS:
             return True
         else:
             return False
 
+    # Returns the highlight duration of the video's channel and when the video was created (or None),
+    # or None if the video isn't known
+    def get_video_risk_info(self, video_url):
+        video_id = self.parse_valid_video_id(video_url)
+        if video_id is None:
+            return None
+
+        video_info = self.cache_info["video_infos"].get(video_id)
+        if video_info is None or video_info.get("missing"):
+            return None
+
+        user_info = self.cache_info["user_infos"].get(video_info["user_login"])
+        if user_info is None:
+            return None
+
+        created_at = video_info.get("created_at")
+        if created_at is not None:
+            created_at = datetime.datetime.fromisoformat(created_at)
+
+        return user_info.get("total_duration", 0), created_at
+
     def write_twitch_users_at_risk(self):
-        twitch_users_sorted_by_total_duration = sorted(self.cache_info["user_infos"].items(), key=lambda x: x[1]["total_duration"], reverse=True)
-        output = "".join(f"{username}: {user_info['total_duration']}\n" for username, user_info in twitch_users_sorted_by_total_duration)
+        # only the durations are kept, not every user's info
+        twitch_users_sorted_by_total_duration = sorted(((username, user_info.get("total_duration", 0)) for username, user_info in self.cache_info["user_infos"].items()), key=lambda x: x[1], reverse=True)
+        output = "".join(f"{username}: {total_duration}\n" for username, total_duration in twitch_users_sorted_by_total_duration)
 
         with open("output/twitch_users_sorted_by_total_duration.txt", "w+") as f:
             f.write(output)
@@ -176,20 +583,17 @@ class UserCache:
         user_info = self.cache_info["user_infos"].get(username)
         if user_info is None:
             user_info = {
-                "c_video_urls": [],
-                "videos": {}
+                "c_video_urls": []
             }
             self.cache_info["user_infos"][username] = user_info
+            self.changed_usernames.add(username)
         return user_info
 
     def save_cache(self):
         exit_after_write = False
-        cache_info_as_str = json.dumps(self.cache_info, indent=2)
         while True:
             try:
-                with open(self.cache_filename, "w+") as f:
-                    f.write(cache_info_as_str)
-
+                self.cache_store.save(self.cache_info)
                 break
             except KeyboardInterrupt:
                 print("Saving Twitch cache, please stop Ctrl-C'ing")
@@ -199,11 +603,13 @@ class UserCache:
             sys.exit(1)
 
 class TwitchClient:
-    __slots__ = ("twitch", "user_cache")
+    __slots__ = ("twitch", "user_cache", "max_concurrency", "max_age")
 
     def __init__(self, args, twitch):
         self.twitch = twitch
-        self.user_cache = UserCache(args.cache_filename)
+        self.user_cache = UserCache(create_cache_store(args.cache_filename, args.twitch_cache_backend))
+        self.max_concurrency = max(1, args.twitch_concurrency)
+        self.max_age = parse_duration(args.twitch_cache_max_age) if args.twitch_cache_max_age else None
 
     @classmethod
     async def init(cls, args):
@@ -216,13 +622,24 @@ class TwitchClient:
 
         return cls(args, twitch)
 
+    # Looks up a batch of videos and their users while runs are still being scraped. Which users are at risk
+    # is only determined (and the cache saved) by fetch_info, once all videos are known.
+    async def fetch_batch_info(self, video_urls):
+        video_ids = await self.user_cache.update_video_infos_from_video_urls(self.twitch, video_urls, save=False)
+        await self.user_cache.update_user_infos_from_video_infos(self.twitch, self.max_concurrency, self.max_age, video_ids, save=False)
+
     async def fetch_info(self, video_urls):
-        await self.user_cache.update_video_infos_from_video_urls(self.twitch, video_urls)
-        await self.user_cache.update_user_infos_from_video_infos(self.twitch)
+        await self.fetch_batch_info(video_urls)
         self.user_cache.determine_at_risk_users()
 
     def is_video_at_risk(self, video_url):
         return self.user_cache.is_video_at_risk(video_url)    
 
+    def get_video_risk_info(self, video_url):
+        return self.user_cache.get_video_risk_info(video_url)
+
     def write_twitch_users_at_risk(self):
         self.user_cache.write_twitch_users_at_risk()
+
+    def close(self):
+        self.user_cache.cache_store.close()
@@ -0,0 +1,161 @@
+import threading
+import sqlite3
+import pathlib
+import os
+
+STORE_FOLDER_NAME = "store"
+STORE_INDEX_FILENAME = "store_index.db"
+# lists the videos of a folder which couldn't be hardlinked there, e.g. because the folder is on another drive
+MANIFEST_FILENAME = "store_manifest.txt"
+
+# Returns what identifies a downloaded video in the store: its id, the chosen format and the downloaded segment if any
+def get_store_key(info):
+    store_key = f"{info['id']}_{info.get('format_id')}"
+    section_start = info.get("section_start")
+    section_end = info.get("section_end")
+    if section_start is not None or section_end is not None:
+        store_key += f"_{section_start or 0:.0f}-" + (f"{section_end:.0f}" if section_end is not None else "end")
+
+    return store_key
+
+def is_same_file(filepath, other_filepath):
+    try:
+        return os.path.samefile(filepath, other_filepath)
+    except OSError:
+        return False
+
+# Videos are downloaded once into the store folder, no matter how many runs, games and users link them.
+# The folders of the games and users get hardlinks to the videos in the store, or an entry in their manifest
+# if hardlinks aren't possible. Which video is in which file, and where it is linked, is kept in an sqlite
+# database in the store folder, which is shared by all games and users.
+class VideoStore:
+    __slots__ = ("lock", "connection", "folder_name")
+
+    def __init__(self, video_folder_name):
+        self.lock = threading.Lock()
+        store_folder_path = pathlib.Path(video_folder_name) / STORE_FOLDER_NAME
+        store_folder_path.mkdir(parents=True, exist_ok=True)
+        self.folder_name = str(store_folder_path)
+        # only ever used under self.lock
+        self.connection = sqlite3.connect(store_folder_path / STORE_INDEX_FILENAME, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS videos (store_key TEXT PRIMARY KEY, filepath TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS videos_filepath ON videos (filepath)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS links (link_filepath TEXT PRIMARY KEY, store_key TEXT NOT NULL, hardlink INTEGER NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS links_store_key ON links (store_key)")
+
+    # Returns the file of the video in the store, or None if it hasn't been downloaded
+    def get_filepath(self, store_key):
+        with self.lock:
+            row = self.connection.execute("SELECT filepath FROM videos WHERE store_key = ?", (store_key,)).fetchone()
+            if row is None:
+                return None
+
+            if not os.path.isfile(row[0]):
+                # deleted by hand, so download it again
+                with self.connection:
+                    self.connection.execute("DELETE FROM videos WHERE store_key = ?", (store_key,))
+                return None
+
+        return row[0]
+
+    def add(self, store_key, filepath):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO videos (store_key, filepath) VALUES (?, ?)", (store_key, filepath))
+
+    # must be called with self.lock held. Returns False if the video is listed in the manifest instead.
+    def create_link(self, store_key, filepath, link_folder_name):
+        link_filepath = str(pathlib.Path(link_folder_name) / pathlib.Path(filepath).name)
+        try:
+            if os.path.isfile(link_filepath):
+                if not os.path.samefile(filepath, link_filepath):
+                    # downloaded into the folder before the store was used, leave that copy alone
+                    return True
+            else:
+                os.link(filepath, link_filepath)
+            hardlink = True
+        except OSError:
+            hardlink = False
+
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO links (link_filepath, store_key, hardlink) VALUES (?, ?, ?)", (link_filepath, store_key, hardlink))
+
+        return hardlink
+
+    # must be called with self.lock held, and inside a transaction
+    def remove_links(self, store_key):
+        rows = self.connection.execute("SELECT link_filepath, hardlink FROM links WHERE store_key = ?", (store_key,)).fetchall()
+        self.connection.execute("DELETE FROM links WHERE store_key = ?", (store_key,))
+        for link_filepath, hardlink in rows:
+            if hardlink:
+                pathlib.Path(link_filepath).unlink(missing_ok=True)
+
+        return [link_filepath for link_filepath, hardlink in rows]
+
+    # must be called with self.lock held
+    def write_manifest(self, link_folder_name):
+        link_folder_path = pathlib.Path(link_folder_name)
+        rows = self.connection.execute("SELECT links.link_filepath, videos.filepath FROM links JOIN videos USING (store_key) WHERE links.hardlink = 0 ORDER BY links.link_filepath").fetchall()
+        manifest_lines = [f"{pathlib.Path(link_filepath).name}\t{filepath}\n" for link_filepath, filepath in rows if pathlib.Path(link_filepath).parent == link_folder_path]
+        manifest_filepath = link_folder_path / MANIFEST_FILENAME
+        if len(manifest_lines) == 0:
+            manifest_filepath.unlink(missing_ok=True)
+            return
+
+        temp_manifest_filepath = link_folder_path / f"{MANIFEST_FILENAME}.tmp"
+        with open(temp_manifest_filepath, "w", encoding="utf-8") as f:
+            f.writelines(manifest_lines)
+
+        os.replace(temp_manifest_filepath, manifest_filepath)
+
+    # Makes the video of the store available in `link_folder_name`
+    def link(self, store_key, filepath, link_folder_name):
+        pathlib.Path(link_folder_name).mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            if not self.create_link(store_key, filepath, link_folder_name):
+                self.write_manifest(link_folder_name)
+
+    # For videos which were converted after downloading, possibly into the same file. Links to the old file are replaced.
+    def replace_file(self, filepath, new_filepath):
+        with self.lock:
+            row = self.connection.execute("SELECT store_key FROM videos WHERE filepath = ?", (filepath,)).fetchone()
+            if row is None:
+                return
+
+            store_key = row[0]
+            if new_filepath == filepath:
+                # converted in place (or not converted at all), hardlinks made before that still have the old video
+                rows = self.connection.execute("SELECT link_filepath FROM links WHERE store_key = ? AND hardlink = 1", (store_key,)).fetchall()
+                link_filepaths = [link_filepath for link_filepath, in rows if not is_same_file(filepath, link_filepath)]
+                for link_filepath in link_filepaths:
+                    pathlib.Path(link_filepath).unlink(missing_ok=True)
+            else:
+                with self.connection:
+                    self.connection.execute("UPDATE videos SET filepath = ? WHERE store_key = ?", (new_filepath, store_key))
+                    link_filepaths = self.remove_links(store_key)
+
+            link_folder_names = frozenset(str(pathlib.Path(link_filepath).parent) for link_filepath in link_filepaths)
+            for link_folder_name in link_folder_names:
+                self.create_link(store_key, new_filepath, link_folder_name)
+                self.write_manifest(link_folder_name)
+
+    # For videos which turned out to be broken and were deleted
+    def remove_file(self, filepath):
+        with self.lock:
+            row = self.connection.execute("SELECT store_key FROM videos WHERE filepath = ?", (filepath,)).fetchone()
+            if row is None:
+                return
+
+            store_key = row[0]
+            with self.connection:
+                self.connection.execute("DELETE FROM videos WHERE store_key = ?", (store_key,))
+                link_filepaths = self.remove_links(store_key)
+
+            for link_folder_name in frozenset(str(pathlib.Path(link_filepath).parent) for link_filepath in link_filepaths):
+                self.write_manifest(link_folder_name)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()